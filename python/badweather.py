@@ -7,9 +7,15 @@ or
 2016-08-10T07:21, 2016-08-10T09:41
 
 The first format marks exposure IDs, inclusive, that were taken in bad
-conditions, and the second format marks times in UT.
+conditions, and the second format marks times in UT.  Where rows overlap,
+the later row in the file wins.
+
+Conditions of tiles are given as uint8 codes into a table of labels, with
+code 0 (label '') for tiles in no interval; condition_strings gives the
+labels themselves.
 """
 
+import os
 import numpy
 import pdb
 from astropy.io import ascii
@@ -17,43 +23,138 @@ from astropy.time import Time
 
 filt2ind = {'g': 0, 'r': 1, 'i': 2, 'z': 3, 'y': 4}
 
+# parsed bad weather files: file name -> (mtime, intervals)
+_interval_cache = {}
 
-def check_bad(dat, badfile):
-    conditions = get_conditions(dat, badfile)
-    return conditions == 'bad'
 
+class Intervals(object):
+    """
+    Inclusive intervals [start, end] with an index each, for lookup of the
+    last interval (highest index) containing given values.
 
-def get_conditions(dat, badfile):
+    The interval ends split the line into points[i] and the gaps between
+    them; point_index[i] and gap_index[i] (between points i and i+1) are the
+    index of the last interval covering them, or -1.
+    """
+
+    def __init__(self, start, end, index):
+        self.points = numpy.unique(numpy.concatenate([start, end]))
+        npt = len(self.points)
+        self.point_index = -numpy.ones(npt, dtype='i8')
+        self.gap_index = -numpy.ones(max(npt-1, 0), dtype='i8')
+        i0 = numpy.searchsorted(self.points, start)
+        i1 = numpy.searchsorted(self.points, end)
+        for a, b, k in sorted(zip(i0, i1, index), key=lambda x: x[2]):
+            self.point_index[a:b+1] = k
+            self.gap_index[a:b] = k
+
+    def lookup(self, val):
+        """Index of the last interval containing each of val, or -1."""
+        val = numpy.asarray(val, dtype='f8')
+        res = -numpy.ones(val.shape, dtype='i8')
+        npt = len(self.points)
+        if npt == 0:
+            return res
+        i = numpy.searchsorted(self.points, val)
+        onpoint = (i < npt) & (self.points[numpy.minimum(i, npt-1)] == val)
+        res[onpoint] = self.point_index[i[onpoint]]
+        ingap = ~onpoint & (i > 0) & (i < npt)
+        res[ingap] = self.gap_index[i[ingap]-1]
+        return res
+
+
+def parse_badfile(badfile):
+    """
+    Intervals of badfile, as a dictionary mapping the tile file fields
+    'expnum' and 'mjd_obs' to Intervals indexed by row number, the
+    condition codes of the rows, and the labels of the codes.
+    """
     badlist = ascii.read(badfile, delimiter=',')
-    conditions = numpy.zeros((len(dat), 5), dtype='a200')
-    for row in badlist:
-        field = None
+    nrow = len(badlist)
+    start = numpy.zeros(nrow, dtype='f8')
+    end = numpy.zeros(nrow, dtype='f8')
+    isexp = numpy.zeros(nrow, dtype='bool')
+    times = []
+    for i, row in enumerate(badlist):
         try:
-            start = int(row['start'])
-            end = int(row['end'])
-            field = 'expnum'
+            start[i] = int(row['start'])
+            end[i] = int(row['end'])
+            isexp[i] = True
         except ValueError:
-            pass
+            times.append(i)
+    if len(times) > 0:
         try:
-            start = Time(row['start'], format='isot', scale='utc')
-            end = Time(row['end'], format='isot', scale='utc')
-            start = start.mjd
-            end = end.mjd
-            field = 'mjd_obs'
+            start[times] = Time([str(badlist['start'][i]) for i in times],
+                                format='isot', scale='utc').mjd
+            end[times] = Time([str(badlist['end'][i]) for i in times],
+                              format='isot', scale='utc').mjd
         except ValueError:
-            pass
-        if field is None:
-            raise ValueError('row format not understood: %s' % row)
-        if start > end:
-            print(row)
-            raise ValueError('file not understood, start > end')
-        condition = row['type'].strip()
-        for f in 'grizy':
+            for i in times:
+                try:
+                    Time(str(badlist['start'][i]), format='isot', scale='utc')
+                    Time(str(badlist['end'][i]), format='isot', scale='utc')
+                except ValueError:
+                    raise ValueError('row format not understood: %s' %
+                                     badlist[i])
+            raise
+    for i in numpy.flatnonzero(start > end):
+        print(badlist[i])
+        raise ValueError('file not understood, start > end')
+    rowlabels = [str(c).strip() for c in badlist['type']] if nrow else []
+    labels, codes = numpy.unique([''] + rowlabels, return_inverse=True)
+    if len(labels) > 256:
+        raise ValueError('too many different conditions')
+    codes = codes[1:].astype('u1')
+    index = numpy.arange(nrow)
+    intervals = {}
+    for field, m in (('expnum', isexp), ('mjd_obs', ~isexp)):
+        intervals[field] = Intervals(start[m], end[m], index[m])
+    return intervals, codes, labels
+
+
+def read_badfile(badfile):
+    """parse_badfile(badfile), cached until the file is modified."""
+    key = os.path.abspath(badfile)
+    mtime = os.path.getmtime(badfile)
+    cached = _interval_cache.get(key)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, parse_badfile(badfile))
+        _interval_cache[key] = cached
+    return cached[1]
+
+
+def check_bad(dat, badfile):
+    conditions, labels = get_conditions(dat, badfile)
+    return conditions == condition_code(labels, 'bad')
+
+
+def condition_code(labels, label):
+    """Code of label in labels, or -1 if it is not there."""
+    code = numpy.flatnonzero(labels == label)
+    return code[0] if len(code) > 0 else -1
+
+
+def condition_strings(conditions, labels):
+    """Labels of condition codes, as a string array."""
+    return labels[conditions]
+
+
+def get_conditions(dat, badfile):
+    """
+    Conditions of the tiles dat in badfile, as an (ntile, 5) uint8 array
+    of codes for the filters grizy, and the array of labels of the codes.
+    """
+    intervals, rowcodes, labels = read_badfile(badfile)
+    conditions = numpy.zeros((len(dat), 5), dtype='u1')
+    for f in 'grizy':
+        index = -numpy.ones(len(dat), dtype='i8')
+        for field in ('expnum', 'mjd_obs'):
             fieldname = f+'_'+field
             try:
                 val = dat[fieldname]
             except:
                 val = dat[fieldname.upper()]
-            m = (val >= start) & (val <= end)
-            conditions[m, filt2ind[f]] = condition
-    return conditions
+            index = numpy.maximum(index, intervals[field].lookup(val))
+        m = index >= 0
+        conditions[m, filt2ind[f]] = rowcodes[index[m]]
+    return conditions, labels
@@ -0,0 +1,211 @@
+"""
+Simulate an observing campaign of many nights.
+
+The tile table is loaded and cut to the footprint once.  Each night is then
+planned in turn with nightstrat.GetNightlyStrategy, and exposures are marked
+done in the table unless they are lost to the weather, so that each night
+picks up where the previous one left off.
+
+Weather losses follow badweather: exposures planned during 'bad' intervals
+of a bad weather file are lost, and whole nights can be lost at random.
+
+python campaign.py 2016-03-13 2016-03-20 decaps-tiles.fits gr sim
+"""
+
+import os
+import numpy as np
+import ephem
+
+import nightstrat
+import badweather
+
+
+def ephem2mjd(date):
+    """MJD of a pyephem date."""
+    return np.asarray(date, dtype='f8') + 15019.5
+
+
+def night_dates(start, end):
+    """YYYY-MM-DD strings of the nights from start to end, inclusive."""
+    d0 = int(np.floor(ephem.Date(start) + 0.5))
+    d1 = int(np.floor(ephem.Date(end) + 0.5))
+    return [ephem.Date(d - 0.5).datetime().strftime('%Y-%m-%d')
+            for d in range(d0, d1+1)]
+
+
+def weather_lost(plan, badfile):
+    """Mask of the exposures in plan taken during conditions marked bad in
+    badfile."""
+    mjd = ephem2mjd(plan['approx_time'])
+    filt = np.char.lower(plan['filter'])
+    cols = []
+    names = []
+    for f in 'grizy':
+        cols.append(np.where(filt == f, mjd, np.nan))
+        cols.append(-np.ones(len(plan), dtype='i8'))
+        names += [f+'_mjd_obs', f+'_expnum']
+    dat = np.rec.fromarrays(cols, names=names)
+    return np.any(badweather.check_bad(dat, badfile), axis=1)
+
+
+def mark_done(survey, plan):
+    """Mark the exposures in plan as done in survey."""
+    order = np.argsort(survey['TILEID'])
+    rows = order[np.searchsorted(survey['TILEID'], plan['TILEID'],
+                                 sorter=order)]
+    for f in 'grizY':
+        m = plan['filter'] == f
+        survey['{:s}_DONE'.format(f.capitalize())][rows[m]] = 1
+
+
+def completion(survey, filters):
+    """Fraction of tiles done in all filters."""
+    done = np.ones(len(survey['TILEID']), dtype='bool')
+    for f in filters:
+        done = done & (survey['{:s}_DONE'.format(f.capitalize())] != 0)
+    return np.mean(done) if len(done) else 1.
+
+
+def simulate(survey, nights, filters, badfile=None, nightloss=0., seed=None,
+             outdir=None, verbose=True, **kw):
+    """
+    Plan and 'observe' nights in turn.
+
+    Inputs:
+        survey     tile table, as the survey returned by
+                   nightstrat.readTilesTable; its *_DONE columns are updated
+        nights     list of YYYY-MM-DD night strings
+        filters    filters to observe
+        badfile    optional bad weather file; planned exposures in its bad
+                   intervals are lost
+        nightloss  probability of losing a whole night
+        seed       random seed for night losses
+        outdir     if set, write each night's plan to outdir/YYYY-MM-DD
+        verbose    print lost nights and the planner's reports
+        **kw       passed to nightstrat.GetNightlyStrategy
+    Output:
+        record array with one row per night: night, number of exposures
+        planned and lost, and completion (fraction of tiles done in all
+        filters) after the night.
+    """
+    rng = np.random.RandomState(seed)
+    rows = []
+    for night in nights:
+        if rng.rand() < nightloss:
+            if verbose:
+                print('Night %s lost to weather.' % night)
+            rows.append((night, 0, 0, completion(survey, filters)))
+            continue
+        obs = nightstrat.decam.copy()
+        obs.date = night
+        obs.date = obs.next_setting(ephem.Sun())
+        plan = nightstrat.GetNightlyStrategy(obs, survey, filters,
+                                             verbose=verbose, **kw)
+        if badfile and len(plan) > 0:
+            lost = weather_lost(plan, badfile)
+        else:
+            lost = np.zeros(len(plan), dtype='bool')
+        mark_done(survey, plan[~lost])
+        if outdir is not None and len(plan) > 0:
+            fname = os.path.join(outdir, night)
+            nightstrat.WriteJSON(plan, fname)
+            nightstrat.write_plan_schedule(plan, fname)
+        rows.append((night, len(plan), np.sum(lost),
+                     completion(survey, filters)))
+    return np.rec.fromrecords(
+        rows, dtype=[('night', 'S10'), ('nexp', 'i4'), ('nlost', 'i4'),
+                     ('completion', 'f8')])
+
+
+def write_summary(summary, fname=None):
+    lines = ['# night        nexp  nlost  completion']
+    for row in summary:
+        lines.append('  {:s}  {:5d}  {:5d}  {:10.4f}'.format(
+            row['night'], row['nexp'], row['nlost'], row['completion']))
+    lines.append('# total        {:5d}  {:5d}'.format(
+        np.sum(summary['nexp']), np.sum(summary['nlost'])))
+    for line in lines:
+        print(line)
+    if fname is not None:
+        with open(fname, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Simulate a campaign of nights.',
+        epilog=('EXAMPLE: %(prog)s 2016-03-13 2016-03-20 decaps-tiles.fits '
+                'gr sim'))
+    parser.add_argument('start', type=str, help='first night, YYYY-MM-DD')
+    parser.add_argument('end', type=str, help='last night, YYYY-MM-DD')
+    parser.add_argument('tilefile', type=str, help='file name of tiles')
+    parser.add_argument('filters', type=str, help='filters to run')
+    parser.add_argument('outdir', type=str,
+                        help='directory for nightly plans and summary')
+    parser.add_argument('--pass', type=int, default=1, dest='skypass',
+                        help='Specify pass (dither) number (1,2, or 3); '
+                        '0 implies all passes.')
+    parser.add_argument('--expand-footprint', action='store_true',
+                        help='Use tiles outside nominal footprint')
+    parser.add_argument(
+        '--rd-bounds', metavar='deg', type=float, nargs=4, default=None,
+        help=('use only tiles in ra/dec range, specified as '
+              '(ramin, ramax, decmin, decmax)'))
+    parser.add_argument(
+        '--lb-bounds', metavar='deg', type=float, nargs=4, default=None,
+        help=('use only tiles in lb range, specified as '
+              '(lmin, lmax, bmin, bmax)'))
+    parser.add_argument('--nightfrac', type=float, default=1.,
+                        help='fraction of each night to plan')
+    parser.add_argument('--moonsep', type=float, default=40.,
+                        help='minimum moon separation to consider')
+    parser.add_argument('--weatherfile', type=str, default='',
+                        help=('mark exposures with bad quality from this '
+                              'file as not yet done before starting'))
+    parser.add_argument('--badweather', type=str, default=None,
+                        help=('lose simulated exposures in the bad '
+                              'intervals of this file'))
+    parser.add_argument('--night-loss', type=float, default=0.,
+                        help='probability of losing each whole night')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='random seed for night losses')
+    parser.add_argument('--optimize_ha', dest='optimize_ha',
+                        action='store_true',
+                        help='optimize on hour angle, not airmass')
+    parser.add_argument('--engine', type=str, default='numpy',
+                        choices=['numpy', 'cube', 'ephem'],
+                        help='tile airmass engine; see nightstrat')
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help='cache night ephemerides for --engine cube')
+    parser.add_argument('--neighbour-radius', metavar='deg', type=float,
+                        default=None,
+                        help=('only consider tiles within this distance of '
+                              'the current pointing, widening as needed'))
+
+    args = parser.parse_args()
+
+    tiles, survey = nightstrat.readTilesTable(
+        args.tilefile,
+        expand_footprint=args.expand_footprint,
+        rdbounds=args.rd_bounds,
+        lbbounds=args.lb_bounds,
+        skypass=args.skypass,
+        weatherfile=args.weatherfile
+    )
+
+    if not os.path.isdir(args.outdir):
+        os.makedirs(args.outdir)
+
+    summary = simulate(survey, night_dates(args.start, args.end),
+                       args.filters, badfile=args.badweather,
+                       nightloss=args.night_loss, seed=args.seed,
+                       outdir=args.outdir, nightfrac=args.nightfrac,
+                       minmoonsep=args.moonsep, optimize_ha=args.optimize_ha,
+                       engine=args.engine, cache_dir=args.cache_dir,
+                       neighbour_radius=args.neighbour_radius)
+    write_summary(summary, os.path.join(args.outdir, 'summary.txt'))
+
+
+if __name__ == "__main__":
+    main()
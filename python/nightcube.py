@@ -0,0 +1,325 @@
+"""
+Night ephemeris cube: tile airmasses and moon separations on a time grid.
+
+Tile positions are fixed over a night and only time moves, so rather than
+computing the airmass of every tile at every step of the planner, we compute
+it once on a fine time grid (30 s by default) and interpolate.  The cube is a
+dictionary of arrays:
+
+    time       (ntime,)        pyephem dates of the grid
+    lst        (ntime,)        local sidereal time (radians, unwrapped)
+    moon_alt   (ntime,)        moon altitude (radians)
+    moon_az    (ntime,)        moon azimuth (radians)
+    airmass    (ntime, ntile)  float32 tile airmass
+    moon_sep   (ntime, ntile)  float32 tile-moon separation (degrees)
+    sun_alt    (ntime,)        sun altitude (radians)
+
+Hour angles are not stored; they follow exactly from the tile RA and the LST
+track (see cube_ha).
+
+Cubes and twilight times can be cached on disk (night_cube,
+cached_twilight_times), so that re-planning the same night with different
+options does no astronomy at all.  Each cache entry is a directory of .npy
+files, loaded memory-mapped, keyed by the night, the observer and a hash of
+the tile coordinates.  The least recently used entries are evicted when the
+cache grows past a size limit.
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+import ephem
+
+import nightstrat
+import skyvec
+
+
+def make_night_cube(obs, ra, dec, t_start, t_end, step=30.):
+    '''
+    Tabulate tile ephemerides from t_start to at least t_end.
+
+    Inputs:
+        obs      pyephem Observer (not modified)
+        ra, dec  J2000 tile coordinates (degrees)
+        t_start  pyephem date at which to start the grid
+        t_end    pyephem date at which to end the grid
+        step     grid spacing (seconds)
+    Output:
+        dictionary of arrays; see module docstring.
+    '''
+    obs = obs.copy()
+    moon = ephem.Moon()
+    sun = ephem.Sun()
+    ntime = int(np.ceil((t_end - t_start) * nightstrat.days_to_s / step)) + 2
+    time = t_start + np.arange(ntime) * step * nightstrat.s_to_days
+    radate, decdate = skyvec.precess(ra, dec, t_start)
+    cube = {
+        'step': float(step),
+        'time': time,
+        'lst': np.zeros(ntime, dtype='f8'),
+        'moon_alt': np.zeros(ntime, dtype='f8'),
+        'moon_az': np.zeros(ntime, dtype='f8'),
+        'sun_alt': np.zeros(ntime, dtype='f8'),
+        'airmass': np.zeros((ntime, len(ra)), dtype='f4'),
+        'moon_sep': np.zeros((ntime, len(ra)), dtype='f4'),
+    }
+    moonvec = np.zeros((ntime, 3), dtype='f8')
+    for i, t in enumerate(time):
+        obs.date = t
+        moon.compute(obs)
+        sun.compute(obs)
+        cube['lst'][i] = obs.sidereal_time()
+        cube['sun_alt'][i] = sun.alt
+        cube['moon_alt'][i] = moon.alt
+        cube['moon_az'][i] = moon.az
+        moonvec[i] = skyvec.radec2vec(np.degrees(moon.ra),
+                                      np.degrees(moon.dec))
+    # sin(alt) = z sin(lat) + cos(lat) (x cos(lst) + y sin(lst)) for tile unit
+    # vectors (x, y, z) of date, so the whole grid is a few outer products
+    # rather than trigonometry on every (time, tile) pair.
+    tilevec = skyvec.radec2vec(radate, decdate)
+    lat = float(obs.lat)
+    # fill in blocks of times, to bound the size of the float64 temporaries
+    nblock = max(1, int(2**22 // max(len(ra), 1)))
+    for i0 in range(0, ntime, nblock):
+        rows = slice(i0, i0+nblock)
+        lst = cube['lst'][rows, None]
+        sinalt = (np.sin(lat)*tilevec[None, :, 2] +
+                  np.cos(lat)*(np.cos(lst)*tilevec[None, :, 0] +
+                               np.sin(lst)*tilevec[None, :, 1]))
+        alt = np.arcsin(np.clip(sinalt, -1., 1.))
+        # refraction at the true altitude: cheaper, and within 0.2 arcmin
+        alt += skyvec.refraction(alt, temp=obs.temp, pressure=obs.pressure,
+                                 iterate=False)
+        cube['airmass'][rows] = nightstrat.alt2airmass(alt)
+        # Separations from the apparent moon position, ignoring differential
+        # refraction (< 1 arcmin).
+        cossep = np.dot(moonvec[rows], tilevec.T)
+        cube['moon_sep'][rows] = np.degrees(
+            np.arccos(np.clip(cossep, -1., 1.)))
+    cube['lst'] = np.unwrap(cube['lst'])
+    return cube
+
+
+def cube_index(cube, t):
+    '''
+    Grid index i and fraction f such that t = time[i] + f*step.
+
+    Times past either end of the grid are clipped to the last interval.
+    '''
+    x = (float(t) - cube['time'][0]) * nightstrat.days_to_s / cube['step']
+    i = int(np.clip(np.floor(x), 0, len(cube['time']) - 2))
+    return i, x - i
+
+
+def cube_interp(cube, name, t, ind=None):
+    '''
+    Linearly interpolate cube[name] to time t, for the tiles ind (all tiles
+    if None).
+    '''
+    i, f = cube_index(cube, t)
+    arr = cube[name]
+    if ind is None:
+        lo, hi = arr[i], arr[i+1]
+    else:
+        lo, hi = arr[i, ind], arr[i+1, ind]
+    lo = lo.astype('f8')
+    return lo + f*(hi.astype('f8') - lo)
+
+
+def cube_lst(cube, t):
+    '''Local sidereal time (radians) at t.'''
+    i, f = cube_index(cube, t)
+    lst = cube['lst']
+    return (lst[i] + f*(lst[i+1] - lst[i])) % (2.*np.pi)
+
+
+def cube_ha(cube, ra, t):
+    '''
+    Hour angle (hours), in the RA - LST convention of
+    nightstrat.GetNightlyStrategy.
+    '''
+    return (ra - np.degrees(cube_lst(cube, t)))/15.
+
+
+def step_ephem_cube(cube, obs, survey_centers, ind=None):
+    """Cube version of nightstrat.step_ephem_numpy.
+
+    The airmass one second later comes from the same grid interval as the
+    airmass now, so its difference is the finite difference of the grid.
+    """
+    if ind is None:
+        ra = survey_centers['RA']
+    else:
+        ra = survey_centers['RA'][ind]
+    airmass = np.zeros((ra.size, 2), dtype='f8')
+    ha = np.zeros((ra.size, 2), dtype='f8')
+    t0 = float(obs.date)
+    i, f = cube_index(cube, t0)
+    if ind is None:
+        lo, hi = cube['airmass'][i], cube['airmass'][i+1]
+    else:
+        lo, hi = cube['airmass'][i, ind], cube['airmass'][i+1, ind]
+    lo = lo.astype('f8')
+    rate = (hi.astype('f8') - lo) / cube['step']
+    airmass[:, 0] = lo + f*cube['step']*rate
+    airmass[:, 1] = airmass[:, 0] + rate
+    for k, dt in enumerate((0., nightstrat.s_to_days)):
+        ha[:, k] = cube_ha(cube, ra, t0 + dt)
+    moonsep = cube_interp(cube, 'moon_sep', t0, ind=ind)
+    return airmass, ha, moonsep
+
+
+#####################################################
+# On-disk cache
+#####################################################
+
+# default maximum size of the cache directory, in bytes
+cache_max_bytes = 4 * 1024**3
+# age (s) after which cache_evict removes leftover temporary directories
+stale_tmp_seconds = 3600.
+
+
+def observer_params(obs):
+    """The parameters of obs that affect cached ephemerides."""
+    return [float(obs.lon), float(obs.lat), float(obs.elev), float(obs.temp),
+            float(obs.pressure), float(obs.horizon)]
+
+
+def tiles_hash(ra, dec):
+    """Hash of a set of tile coordinates."""
+    h = hashlib.sha1()
+    for arr in (ra, dec):
+        h.update(np.ascontiguousarray(arr, dtype='f8').tobytes())
+    return h.hexdigest()
+
+
+def cache_key(*parts):
+    """Cache key for JSON-serializable parts."""
+    return hashlib.sha1(json.dumps(parts).encode('ascii')).hexdigest()
+
+
+def cache_load(cache_dir, key):
+    """
+    Load cache entry key from cache_dir.
+
+    Returns (arrays, meta), where arrays are read-only memory maps, or None if
+    there is no such entry.
+    """
+    path = os.path.join(cache_dir, key)
+    metafile = os.path.join(path, 'meta.json')
+    if not os.path.exists(metafile):
+        return None
+    try:
+        with open(metafile) as f:
+            meta = json.load(f)
+        arrays = dict((name, np.load(os.path.join(path, name + '.npy'),
+                                     mmap_mode='r'))
+                      for name in meta['arrays'])
+    except (IOError, OSError, ValueError, KeyError):
+        # damaged entry: remove it, so that it can be written again
+        shutil.rmtree(path, ignore_errors=True)
+        return None
+    os.utime(metafile, None)  # mark as recently used, for cache_evict
+    return arrays, meta['meta']
+
+
+def cache_save(cache_dir, key, arrays, meta, max_bytes=None):
+    """
+    Save arrays (dict of numpy arrays) and meta (JSON-serializable) as cache
+    entry key in cache_dir, then evict old entries down to max_bytes.
+
+    The entry is written to a temporary directory and renamed into place, so
+    concurrent readers never see a partial entry.
+    """
+    path = os.path.join(cache_dir, key)
+    tmppath = path + '.tmp%d' % os.getpid()
+    if not os.path.isdir(tmppath):
+        os.makedirs(tmppath)
+    for name, arr in arrays.items():
+        np.save(os.path.join(tmppath, name + '.npy'), arr)
+    with open(os.path.join(tmppath, 'meta.json'), 'w') as f:
+        json.dump({'arrays': sorted(arrays.keys()), 'meta': meta}, f)
+    if os.path.isdir(path) and cache_load(cache_dir, key) is None:
+        # an entry without meta.json, which cache_load does not remove
+        shutil.rmtree(path, ignore_errors=True)
+    try:
+        os.rename(tmppath, path)
+    except OSError:
+        # someone else wrote this entry first
+        shutil.rmtree(tmppath, ignore_errors=True)
+    cache_evict(cache_dir,
+                max_bytes if max_bytes is not None else cache_max_bytes)
+
+
+def cache_evict(cache_dir, max_bytes):
+    """Remove least recently used entries until cache_dir is under
+    max_bytes, and temporary directories of cache_save older than
+    stale_tmp_seconds (left by a crash)."""
+    entries = []
+    total = 0
+    now = time.time()
+    for key in os.listdir(cache_dir):
+        if '.tmp' in key:
+            tmppath = os.path.join(cache_dir, key)
+            try:
+                age = now - os.path.getmtime(tmppath)
+            except OSError:
+                continue
+            if age > stale_tmp_seconds:
+                shutil.rmtree(tmppath, ignore_errors=True)
+            continue
+        metafile = os.path.join(cache_dir, key, 'meta.json')
+        if not os.path.exists(metafile):
+            continue
+        size = sum(os.path.getsize(os.path.join(cache_dir, key, fn))
+                   for fn in os.listdir(os.path.join(cache_dir, key)))
+        entries.append((os.path.getmtime(metafile), size, key))
+        total += size
+    for mtime, size, key in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(os.path.join(cache_dir, key), ignore_errors=True)
+        total -= size
+
+
+def night_cube(obs, ra, dec, t_start, t_end, step=30., cache_dir=None,
+               max_bytes=None):
+    """
+    As make_night_cube, but reuse a cube from cache_dir if one was made for
+    the same times, observer and tiles.
+    """
+    if cache_dir is None:
+        return make_night_cube(obs, ra, dec, t_start, t_end, step=step)
+    key = cache_key('cube', float(t_start), float(t_end), float(step),
+                    observer_params(obs), tiles_hash(ra, dec))
+    entry = cache_load(cache_dir, key)
+    if entry is not None:
+        cube, meta = entry
+        cube['step'] = meta['step']
+        return cube
+    cube = make_night_cube(obs, ra, dec, t_start, t_end, step=step)
+    arrays = dict((k, v) for k, v in cube.items() if k != 'step')
+    cache_save(cache_dir, key, arrays, {'step': cube['step']},
+               max_bytes=max_bytes)
+    return cube
+
+
+def cached_twilight_times(datestr, cache_dir, max_bytes=None):
+    """nightstrat.twilight_times, cached in cache_dir."""
+    key = cache_key('twilight', datestr,
+                    observer_params(nightstrat.decam))
+    entry = cache_load(cache_dir, key)
+    if entry is None:
+        times = nightstrat.twilight_times(datestr)
+        cache_save(cache_dir, key, {},
+                   [[k, float(v)] for k, v in times.items()],
+                   max_bytes=max_bytes)
+    else:
+        times = OrderedDict((k, ephem.Date(v)) for k, v in entry[1])
+    return times
@@ -10,9 +10,13 @@ from astropy.io import fits
 import ephem
 import numpy as np
 import json
+import time
 
 import pdb
 
+import skyvec
+from skyvec import equgal, gc_dist
+
 from collections import OrderedDict
 
 # Global constants
@@ -31,6 +35,7 @@ decam.pressure = 780.0  # mbar
 decam.horizon = -ephem.degrees('12:00:00.0')
 
 exp_time_filters = {'g': 96, 'r': 30, 'i': 30, 'z': 30, 'Y': 30}
+filter_bits = {'g': 1, 'r': 2, 'i': 4, 'z': 8, 'Y': 16}
 filter_symbols = {'g': 's', 'r': 'p', 'i': '<', 'z': 'o', 'Y': '*'}
 
 sun = ephem.Sun()
@@ -46,32 +51,35 @@ def alt2airmass(alt):
     Uses the Hardie (1962) interpolation function.
     '''
 
-    if isinstance(alt, list):
-        alt[alt < 0.07] = 0.07
+    if isinstance(alt, (list, np.ndarray)):
+        alt = np.clip(np.asarray(alt, dtype='f8'), 0.07, np.inf)
     else:
         alt = max(alt, 0.07)
 
     secz = 1.0 / np.sin(alt)
     seczm1 = secz - 1.0
 
-    airm = (secz - 0.0018167*seczm1 - 0.002875*seczm1**2 -
-            0.0008083*seczm1**3)
+    airm = secz - seczm1*(0.0018167 + seczm1*(0.002875 + 0.0008083*seczm1))
 
     return airm
 
 
-def radec2airmass(obs, ra, dec):
+def tile_body(ra, dec):
+    """pyephem body at J2000 ra, dec (deg)."""
     b = ephem.FixedBody()
     b._ra = np.radians(ra)
     b._dec = np.radians(dec)
+    return b
+
+
+def radec2airmass(obs, ra, dec):
+    b = tile_body(ra, dec)
     b.compute(obs)
     return alt2airmass(b.alt)
 
 
 def radec_obj_dist(obs, ra, dec, obj):
-    b = ephem.FixedBody()
-    b._ra = np.radians(ra)
-    b._dec = np.radians(dec)
+    b = tile_body(ra, dec)
     b.compute(obs)
     obj.compute(obs)
     return np.degrees(ephem.separation(b, obj))
@@ -97,7 +105,9 @@ def night_start_end(obs, obj=None):
     return t_start, t_end
 
 
-def night_times(datestr):
+def twilight_times(datestr):
+    """Sun, twilight and moon rise/set times for the night starting on
+    datestr, as an OrderedDict of pyephem dates."""
     obs = decam.copy()
     obs.date = datestr
     obs.horizon = 0.0
@@ -113,92 +123,79 @@ def night_times(datestr):
     obs.horizon = -ephem.degrees('0')
     obs.date = t_sunset
     t_moonset, t_moonrise = night_start_end(obs, ephem.Moon())
-    print('Sunset:       %s, Sunrise:    %s' % (t_sunset, t_sunrise))
-    print('10 twi start: %s, 10 twi end: %s' % (t_10start, t_10stop))
-    print('12 twi start: %s, 12 twi end: %s' % (t_12start, t_12stop))
-    print('18 twi start: %s, 18 twi end: %s' % (t_18start, t_18stop))
-    print('moonset:      %s, moonrise:   %s' % (t_moonset, t_moonrise))
-    print('Q1:           %s' % q1)
-    print('Q2:           %s' % q2)
-    print('Q3:           %s' % q3)
+    return OrderedDict([
+        ('sunset', t_sunset), ('sunrise', t_sunrise),
+        ('10start', t_10start), ('10stop', t_10stop),
+        ('12start', t_12start), ('12stop', t_12stop),
+        ('18start', t_18start), ('18stop', t_18stop),
+        ('moonset', t_moonset), ('moonrise', t_moonrise),
+        ('q1', q1), ('q2', q2), ('q3', q3)])
+
+
+def night_times(datestr, cache_dir=None):
+    if cache_dir is not None:
+        import nightcube
+        t = nightcube.cached_twilight_times(datestr, cache_dir)
+    else:
+        t = twilight_times(datestr)
+    print('Sunset:       %s, Sunrise:    %s' % (t['sunset'], t['sunrise']))
+    print('10 twi start: %s, 10 twi end: %s' % (t['10start'], t['10stop']))
+    print('12 twi start: %s, 12 twi end: %s' % (t['12start'], t['12stop']))
+    print('18 twi start: %s, 18 twi end: %s' % (t['18start'], t['18stop']))
+    print('moonset:      %s, moonrise:   %s' % (t['moonset'], t['moonrise']))
+    print('Q1:           %s' % t['q1'])
+    print('Q2:           %s' % t['q2'])
+    print('Q3:           %s' % t['q3'])
 
 #####################################################
 # Misc.
 #####################################################
 
-def ConvertRA(raval):
-    hours = np.zeros_like(raval)
-    minutes = np.zeros_like(raval)
-    seconds = np.zeros_like(raval)
-
-    hours = (raval/360.0)*24.0
-    minutes = (hours-np.floor(hours))*60.0
-    seconds = (minutes-np.floor(minutes))*60.0
+def _put_digits(buf, col, val, ndigit):
+    """Write the ndigit-digit decimal integers val into columns col, col+1,
+    ... of the uint8 character buffer buf."""
+    for k in range(ndigit):
+        buf[:, col+ndigit-1-k] = ord('0') + (val // 10**k) % 10
 
-    stringra = []
-    for k in range(0, raval.size):
-        # print hours[k],minutes[k], seconds[k]
-        stringra.append("%02d:%02d:%04.1f" %
-                        (hours[k], minutes[k], seconds[k]))
 
-    stringra = np.array(stringra)
-    return stringra
+def ConvertRA(raval):
+    """RA (deg) as fixed-width HH:MM:SS.s strings."""
+    raval = np.atleast_1d(np.asarray(raval, dtype='f8'))
+    # work in integer tenths of a second of time, so rounding carries
+    tenths = np.round(np.mod(raval, 360.)/15.*36000.).astype('i8') % 864000
+    buf = np.zeros((raval.size, 10), dtype='u1')
+    _put_digits(buf, 0, tenths // 36000, 2)
+    _put_digits(buf, 3, (tenths // 600) % 60, 2)
+    _put_digits(buf, 6, (tenths // 10) % 60, 2)
+    _put_digits(buf, 9, tenths % 10, 1)
+    buf[:, [2, 5]] = ord(':')
+    buf[:, 8] = ord('.')
+    return buf.view('S10').ravel()
 
 
 #######################################################
 def ConvertDec(decval):
-    sdd = np.zeros_like(decval)
-    minutes = np.zeros_like(decval)
-    seconds = np.zeros_like(decval)
-
-    sdd = decval
-    pos_sdd = np.fabs(sdd)
-    minutes = (pos_sdd-np.floor(pos_sdd))*60.0
-    seconds = (minutes-np.floor(minutes))*60.0
-
-    stringdec = []
-    for k in range(0, decval.size):
-        # print sdd[k],minutes[k], seconds[k]
-        stringdec.append("%02d:%02d:%02d" % (sdd[k], minutes[k], seconds[k]))
-
-    stringdec = np.array(stringdec)
-    return stringdec
+    """Dec (deg) as fixed-width +DD:MM:SS strings."""
+    decval = np.atleast_1d(np.asarray(decval, dtype='f8'))
+    arcsec = np.round(np.abs(decval)*3600.).astype('i8')
+    buf = np.zeros((decval.size, 9), dtype='u1')
+    # sign from decval itself, so that -0.x degrees keeps its sign
+    buf[:, 0] = np.where((decval < 0) & (arcsec > 0), ord('-'), ord('+'))
+    _put_digits(buf, 1, arcsec // 3600, 2)
+    _put_digits(buf, 4, (arcsec // 60) % 60, 2)
+    _put_digits(buf, 7, arcsec % 60, 2)
+    buf[:, [3, 6]] = ord(':')
+    return buf.view('S9').ravel()
 #####################################################
 #####################################################
 
 
-def gc_dist(lon1, lat1, lon2, lat2):
-    '''
-    Great-circle distance between two points on a sphere.
-    Inputs:
-        lon1  longitude (in degrees) of the first point
-        lat1  latitude (in degrees) of the first point
-        lon2  longitude (in degrees) of the second point
-        lat2  latitude (in degrees) of the second point
-    Output:
-        dist  angular distance (in degrees) between the two points.
-    '''
-    lon1 = np.radians(lon1)
-    lat1 = np.radians(lat1)
-    lon2 = np.radians(lon2)
-    lat2 = np.radians(lat2)
-
-    return np.degrees(
-        2. * np.arcsin(
-            np.sqrt(
-                np.sin(0.5*(lat1-lat2))**2 +
-                np.cos(lat1) * np.cos(lat2) * np.sin(0.5*(lon1-lon2))**2
-            )
-        )
-    )
-
-
-#####################################################
-def WriteJSON(pl, fname, chunks=1):
-    # Convert the plan into a list of dictionaries
+def plan_to_json(pl):
+    """The plan as a list of exposure dictionaries, as written by
+    WriteJSON."""
     n_exposures = len(pl['RA'])
 
-    exposure_list = ([
+    return ([
         {
             'expType': 'object',
             'object': 'DECaPS_{:d}_{:s}'.format(pl['TILEID'][k],
@@ -213,6 +210,12 @@ def WriteJSON(pl, fname, chunks=1):
         for k in range(n_exposures)
     ])
 
+
+def WriteJSON(pl, fname, chunks=1):
+    # Convert the plan into a list of dictionaries
+    n_exposures = len(pl['RA'])
+    exposure_list = plan_to_json(pl)
+
     # Write to JSON
     chunk_size = int(np.ceil(float(n_exposures) / float(chunks)))
 
@@ -252,37 +255,63 @@ def gen_decam_json(ra, dec, filters, obj_name, fname, dither=False):
     f.close()
 
 
-def equgal(ra, dec):
-    coord = [ephem.Galactic(ephem.Equatorial(ra0*np.pi/180., dec0*np.pi/180.))
-             for ra0, dec0 in zip(ra, dec)]
-    l = np.array([coord0.lon*180./np.pi for coord0 in coord])
-    b = np.array([coord0.lat*180./np.pi for coord0 in coord])
-    return l, b
-
+# columns of the tile file used for planning, read as ints and floats
+int_columns = ['TILEID', 'PASS', 'IN_SDSS', 'IN_DES', 'IN_DESI', 'IN_DECAPS',
+               'G_DONE', 'R_DONE', 'I_DONE', 'Z_DONE', 'Y_DONE',
+               'G_EXPNUM', 'R_EXPNUM', 'I_EXPNUM', 'Z_EXPNUM', 'Y_EXPNUM']
+float_columns = ['RA', 'DEC', 'EBV_MED',
+                 'G_MJD_OBS', 'R_MJD_OBS', 'I_MJD_OBS', 'Z_MJD_OBS',
+                 'Y_MJD_OBS']
+# columns of the survey that the planner needs
+survey_columns = ['TILEID', 'RA', 'DEC',
+                  'G_DONE', 'R_DONE', 'I_DONE', 'Z_DONE', 'Y_DONE']
+
+
+def tile_column(tiles_in, col, rows=None):
+    """Column col of the tile table tiles_in, for rows (default all), as
+    ints or floats."""
+    val = tiles_in[col]
+    if rows is not None:
+        val = val[rows]
+    return np.asarray(val, dtype=float if col in float_columns else int)
+
+
+def unmark_bad(tiles, tiles_in, weatherfile, rows=None):
+    """Set the *_DONE columns of tiles (rows of tiles_in) to not done for
+    exposures marked bad in weatherfile."""
+    import badweather
+    cols = [f+field for f in 'GRIZY' for field in ('_EXPNUM', '_MJD_OBS')]
+    times = np.rec.fromarrays([tile_column(tiles_in, col, rows)
+                               for col in cols], names=cols)
+    badtiles = badweather.check_bad(times, weatherfile)
+    for filt, ind in zip('GRIZY', range(5)):
+        if filt+'_DONE' not in tiles:
+            continue
+        tiles[filt+'_DONE'] = (
+            tiles[filt+'_DONE'] & (badtiles[:, ind] == 0))
 
-def readTilesTable(filename, expand_footprint=False, rdbounds=None,
-                   lbbounds=None, skypass=-1, weatherfile=None):
-    tiles_in = fits.getdata(filename, 1)
 
-    if weatherfile:
-        import badweather
-        badtiles = badweather.check_bad(tiles_in, weatherfile)
-        for filt, ind in zip('grizy', range(5)):
-            tiles_in[filt+'_done'] = (
-                tiles_in[filt+'_done'] & (badtiles[:, ind] == 0))
+def read_tiles(filename, weatherfile=None):
+    """The columns of the tile file used for planning, as an OrderedDict,
+    with exposures marked bad in weatherfile set to not done.  Observations
+    in the delta log of the file are included, and filename may also be a
+    tilefile.TileStore directory."""
+    import tilefile
+    tiles_in = tilefile.read(filename)
 
     tiles = OrderedDict()
     # Check that required columns exist
-    for col in (['TILEID', 'PASS', 'IN_SDSS', 'IN_DES', 'IN_DESI', 'IN_DECAPS',
-                 'G_DONE', 'R_DONE', 'I_DONE', 'Z_DONE', 'Y_DONE',
-                 'G_EXPNUM', 'R_EXPNUM', 'I_EXPNUM', 'Z_EXPNUM', 'Y_EXPNUM']):
-        tiles[col] = tiles_in[col].astype(int)
-    for col in ['RA', 'DEC', 'EBV_MED',
-                'G_MJD_OBS', 'R_MJD_OBS', 'I_MJD_OBS', 'Z_MJD_OBS',
-                'Y_MJD_OBS']:
-        tiles[col] = tiles_in[col].astype(float)
-
-    # Cut to tiles of interest:
+    for col in int_columns + float_columns:
+        tiles[col] = tile_column(tiles_in, col)
+    if weatherfile:
+        unmark_bad(tiles, tiles_in, weatherfile)
+    return tiles
+
+
+def tile_mask(tiles, expand_footprint=False, rdbounds=None, lbbounds=None,
+              skypass=-1):
+    """Mask of the survey tiles of interest in tiles.  Galactic coordinates
+    are only computed for tiles passing the other cuts."""
     if expand_footprint:
         I = (tiles['IN_DECAPS'] & 2**1) != 0
     else:
@@ -292,24 +321,68 @@ def readTilesTable(filename, expand_footprint=False, rdbounds=None,
         I = I & (tiles['PASS'] == skypass)
 
     if rdbounds is not None:
-        I = (I & (tiles['RA'] > rdbounds[0]) & (tiles['RA'] <= rdbounds[1]) &
-             (tiles['DEC'] > rdbounds[2]) & (tiles['DEC'] <= rdbounds[3]))
+        ra, dec = tiles['RA'], tiles['DEC']
+        I = (I & (ra > rdbounds[0]) & (ra <= rdbounds[1]) &
+             (dec > rdbounds[2]) & (dec <= rdbounds[3]))
 
     if lbbounds is not None:
-        lt, bt = equgal(tiles['RA'], tiles['DEC'])
+        ind = np.flatnonzero(I)
+        lt, bt = equgal(tile_column(tiles, 'RA', ind),
+                        tile_column(tiles, 'DEC', ind))
         lt2 = ((lt + 180.) % 360.) - 180.
-        I = (I &
-             ((((lt > lbbounds[0]) & (lt <= lbbounds[1])) |
-              ((lt2 > lbbounds[0]) & (lt2 <= lbbounds[1]))) &
-              (bt > lbbounds[2]) & (bt <= lbbounds[3])))
+        I[ind] = ((((lt > lbbounds[0]) & (lt <= lbbounds[1])) |
+                   ((lt2 > lbbounds[0]) & (lt2 <= lbbounds[1]))) &
+                  (bt > lbbounds[2]) & (bt <= lbbounds[3]))
+    return I
+
+
+def select_survey(tiles, expand_footprint=False, rdbounds=None,
+                  lbbounds=None, skypass=-1, sexagesimal=False):
+    """Cut tiles (from read_tiles) to the survey tiles of interest."""
+    I = tile_mask(tiles, expand_footprint=expand_footprint,
+                  rdbounds=rdbounds, lbbounds=lbbounds, skypass=skypass)
+
+    # asarray: rows of read-only memory maps come back as writeable copies
+    survey = OrderedDict([(k, np.asarray(v)[I]) for k, v in tiles.items()])
+
+    # H:M:S and D:M:S strings; the planner itself works in degrees
+    if sexagesimal:
+        survey['RA_STR'] = ConvertRA(survey['RA'])
+        survey['DEC_STR'] = ConvertDec(survey['DEC'])
+
+    return survey
+
+
+def readTilesTable(filename, expand_footprint=False, rdbounds=None,
+                   lbbounds=None, skypass=-1, weatherfile=None,
+                   sexagesimal=False, columns=None):
+    """
+    Read the survey tiles of interest from the tile file filename.
 
-    survey = OrderedDict([(k, v[I]) for k, v in tiles.items()])
+    The whole table is loaded, but the cuts are made on its raw columns
+    and only columns (default survey_columns) of the tiles passing them are
+    copied and converted, rather than every column of every tile.
 
-    # H:M:S and D:M:S strings
-    survey['RA_STR'] = ConvertRA(survey['RA'])
-    survey['DEC_STR'] = ConvertDec(survey['DEC'])
+    Returns the tile table as read (see tilefile.read) and the survey, an
+    OrderedDict of columns as from select_survey.
+    """
+    import tilefile
+    tiles_in = tilefile.read(filename)
+    I = tile_mask(tiles_in, expand_footprint=expand_footprint,
+                  rdbounds=rdbounds, lbbounds=lbbounds, skypass=skypass)
+    rows = np.flatnonzero(I)
+
+    survey = OrderedDict()
+    for col in (survey_columns if columns is None else columns):
+        survey[col] = tile_column(tiles_in, col, rows)
+    if weatherfile:
+        unmark_bad(survey, tiles_in, weatherfile, rows)
 
-    return tiles, survey
+    if sexagesimal:
+        survey['RA_STR'] = ConvertRA(survey['RA'])
+        survey['DEC_STR'] = ConvertDec(survey['DEC'])
+
+    return tiles_in, survey
 
 
 def slewtime(ra1, de1, ra2, de2):
@@ -317,28 +390,261 @@ def slewtime(ra1, de1, ra2, de2):
     return 3.*np.clip(gc_dist(ra1, de1, ra2, de2) - 2., 0., np.inf)
 
 
+def tile_altaz(obs, radate, decdate):
+    """Vectorized alt, az (radians) for obs of tiles at radate, decdate
+    (degrees, precessed to the equinox of date with skyvec.precess)."""
+    return skyvec.radec2altaz(radate, decdate, float(obs.sidereal_time()),
+                              float(obs.lat), temp=obs.temp,
+                              pressure=obs.pressure)
+
+
+def step_ephem_numpy(obs, survey_centers, radate, decdate, ind=None):
+    """Airmass and hour angle at obs.date and one second later, and moon
+    separation (deg) at obs.date, for all tiles (or tiles ind) at once.
+
+    Numpy replacement for step_ephem_ephem.  Altitudes agree with pyephem to
+    better than 1 arcmin above the 0.07 rad floor of alt2airmass, so airmasses
+    agree to better than 0.005 (and 3e-4 below airmass 2).
+    """
+    ra = survey_centers['RA']
+    if ind is not None:
+        ra, radate, decdate = ra[ind], radate[ind], decdate[ind]
+    start_obsdate = obs.date
+    moon.compute(obs)
+    airmass = np.zeros((ra.size, 2), dtype='f8')
+    ha = np.zeros((ra.size, 2), dtype='f8')
+    for k, dt in enumerate((0., s_to_days)):
+        obs.date = start_obsdate + dt
+        alt, az = tile_altaz(obs, radate, decdate)
+        if k == 0:
+            moonsep = gc_dist(np.degrees(az), np.degrees(alt),
+                              np.degrees(moon.az), np.degrees(moon.alt))
+        airmass[:, k] = alt2airmass(alt)
+        ha[:, k] = (ra - np.degrees(obs.sidereal_time()))/15.
+    obs.date = start_obsdate
+    return airmass, ha, moonsep
+
+
+def step_ephem_ephem(obs, survey_centers, ind=None):
+    """As step_ephem_numpy, but with one pyephem body per tile.
+
+    Slow; kept to validate the numpy engine.
+    """
+    if ind is None:
+        ind = np.arange(survey_centers['RA'].size)
+    start_obsdate = obs.date
+    airmass = np.zeros((ind.size, 2), dtype='f8')
+    ha = np.zeros((ind.size, 2), dtype='f8')
+    moonsep = np.zeros((ind.size), dtype='f8')
+
+    for j, tile in enumerate(ind):
+        this_tile = tile_body(survey_centers['RA'][tile],
+                              survey_centers['DEC'][tile])
+        moon.compute(obs)
+        this_tile.compute(obs)
+        moonsep[j] = ephem.separation((this_tile.az, this_tile.alt),
+                                      (moon.az, moon.alt))*180./np.pi
+        for k, dt in enumerate((0., s_to_days)):
+            obs.date = start_obsdate + dt
+            this_tile.compute(obs)
+            airmass[j, k] = alt2airmass(float(this_tile.alt))
+            ha[j, k] = (survey_centers['RA'][tile] -
+                        np.degrees(obs.sidereal_time()))/15.
+        obs.date = start_obsdate
+
+    obs.date = start_obsdate  # reset date
+    return airmass, ha, moonsep
+
+
+# Columns of a plan
+plan_dtype = [('TILEID', 'i8'), ('RA', 'f8'), ('DEC', 'f8'), ('filter', 'S1'),
+              ('exp_time', 'i8'), ('airmass', 'f8'), ('ha', 'f8'),
+              ('lst', 'f8'), ('moon_sep', 'f8'), ('moon_alt', 'f8'),
+              ('approx_time', 'f8')]
+
+
+class PlanBuffer(object):
+    """Growable plan: a structured array of dtype plan_dtype, of which the
+    first len(self) rows are filled.
+
+    plan['RA'] etc. are views of the filled part of a column, and torec()
+    gives the filled rows as a record array without copying.
+    """
+
+    def __init__(self, size=256):
+        self.data = np.zeros(size, dtype=plan_dtype)
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, key):
+        return self.data[key][:self.n]
+
+    def append(self, **row):
+        """Add an exposure with the given column values."""
+        if self.n == len(self.data):
+            data = np.zeros(2*len(self.data), dtype=plan_dtype)
+            data[:self.n] = self.data
+            self.data = data
+        for key, val in row.items():
+            self.data[key][self.n] = val
+        self.n += 1
+
+    def torec(self):
+        return self.data[:self.n].view(np.recarray)
+
+
+def lookahead_pick(score_tiles, obs, pool, nexp, duration, ra, dec, pointing,
+                   t_end, depth=3, width=5, airmass_weight=100.,
+                   margin=60., deadline=None):
+    """
+    Beam search for the next pointing among the tiles pool.
+
+    A sequence of pointings costs its total slew time (s) plus
+    airmass_weight times the airmass of each of its exposures, at the time
+    the sequence reaches it.  Sequences are extended one pointing at a time
+    by the width tiles of pool not yet in them with the best greedy scores,
+    at the time and from the position where the sequence leaves the
+    telescope, and the width cheapest sequences are kept.  The greedy
+    sequence, which takes the best-scoring tile at every step, is followed
+    alongside.  After depth pointings, the first tile of the cheapest
+    sequence as long as the greedy one is returned if it costs at least
+    margin (s) less than the greedy sequence, and the first tile of the
+    greedy sequence otherwise.  Without the margin, gains within the
+    horizon are often paid back later in the night.
+
+    Inputs:
+        score_tiles     function(ind, pointing) giving the greedy scores,
+                        exclusion mask, slew times and airmasses of tiles
+                        ind at obs.date, as in GetNightlyStrategy
+        obs             observer; obs.date is the start time of the next
+                        pointing, and is changed
+        pool            indices of the candidate tiles
+        nexp            number of exposures of each tile of pool
+        duration        time (s) to observe each tile of pool
+        ra, dec         positions of the tiles of pool (deg)
+        pointing        current (ra, dec) of the telescope
+        t_end           end of the plan (pyephem date); sequences stop there
+        depth           number of pointings to look ahead
+        width           number of sequences kept
+        airmass_weight  cost (s) of one unit of airmass per exposure
+        margin          saving (s) needed to depart from the greedy choice
+        deadline        time.time() after which to stop searching and use
+                        the best sequence so far
+    Output:
+        the tile index to observe next, or None if no tile of pool can be
+        observed.
+    """
+    # Sequences are (cost, positions in pool, time at their end, ra, dec).
+    # Their extensions, best greedy score first, are kept by positions in
+    # pool, so that the greedy sequence is not scored twice.
+    extensions = {}
+
+    def extend(entry):
+        cost, seq, t, ra0, dec0 = entry
+        if tuple(seq) in extensions:
+            return extensions[tuple(seq)]
+        free = np.setdiff1d(np.arange(len(pool)), seq)
+        children = []
+        if len(free) > 0 and t <= t_end:
+            obs.date = t
+            score, exclude, slew, airmass = score_tiles(pool[free],
+                                                        (ra0, dec0))
+            for j in np.argsort(-score):
+                if exclude[j]:
+                    break
+                k = free[j]
+                children.append(
+                    (cost + slew[j] + airmass_weight*nexp[k]*airmass[j],
+                     seq + [k], t + (duration[k] + slew[j])*s_to_days,
+                     ra[k], dec[k]))
+        extensions[tuple(seq)] = children
+        return children
+
+    greedy = (0., [], float(obs.date), pointing[0], pointing[1])
+    beam = [greedy]
+    for level in range(depth):
+        extended = []
+        for entry in beam:
+            extended.extend(extend(entry)[:width] or [entry])
+        beam = sorted(extended, key=lambda entry: entry[0])[:width]
+        greedy = (extend(greedy) or [greedy])[0]
+        if deadline is not None and time.time() > deadline:
+            break
+    if len(greedy[1]) == 0:
+        return None
+    # shorter sequences leave the telescope idle, and look cheap only
+    # because they stop early
+    rivals = [entry for entry in beam if len(entry[1]) >= len(greedy[1])]
+    if rivals:
+        best = rivals[0]
+        if best[0] < greedy[0] - margin:
+            return pool[best[1][0]]
+    return pool[greedy[1][0]]
+
+
+def plan_stats(plan):
+    """Number of exposures, total slew time (s) and mean airmass of plan."""
+    if len(plan) > 1:
+        slew = np.sum(slewtime(plan['RA'][:-1], plan['DEC'][:-1],
+                               plan['RA'][1:], plan['DEC'][1:]))
+    else:
+        slew = 0.
+    if len(plan) > 0:
+        airmass = np.mean(plan['airmass'])
+    else:
+        airmass = np.nan
+    return OrderedDict([('nexp', len(plan)), ('slew', slew),
+                        ('airmass', airmass)])
+
+
 def GetNightlyStrategy(obs, survey_centers, filters, nightfrac=1.,
-                       minmoonsep=40., optimize_ha=False):
+                       minmoonsep=40., optimize_ha=False, engine='numpy',
+                       cube_step=30., cache_dir=None,
+                       neighbour_radius=None, lookahead=0, beam_width=5,
+                       time_budget=None, airmass_weight=100.,
+                       max_exposures=None, cube=None, pointing=None,
+                       verbose=True):
     """date: UT; if time is not set, the next setting of the sun following start
     of that date is the start of the plan; awkward when the night starts just
     before midnight UT, as it does in March in Chile!
+
+    engine: 'numpy' computes tile airmasses for all tiles at once
+    (step_ephem_numpy); 'cube' tabulates them once for the whole night on a
+    grid with spacing cube_step seconds and interpolates (see nightcube);
+    'ephem' uses one pyephem body per tile (step_ephem_ephem), and is only
+    useful to validate the others.  With the cube engine, cubes are cached in
+    cache_dir if it is given, so repeated plans of the same night skip the
+    ephemeris work.
+
+    neighbour_radius: if given (deg), only consider open tiles within this
+    radius of the current pointing, found with a tileindex.TileIndex; the
+    radius is doubled until some tile there can be observed.  Distant tiles
+    rarely win against the slew penalty, so this seldom changes the plan,
+    and it makes each step cost O(nearby tiles) rather than O(all tiles).
+
+    lookahead: if > 0, choose each pointing by a beam search over the next
+    lookahead pointings (see lookahead_pick), keeping the beam_width
+    cheapest partial sequences, where a sequence costs its slew time plus
+    airmass_weight seconds per unit airmass of each exposure.  The greedy
+    choice is kept unless a sequence starting otherwise costs a minute less
+    than the greedy sequence.  time_budget (s) bounds the wall clock time spent
+    searching; once it is used up the rest of the night is planned
+    greedily.
+
+    max_exposures: stop once the plan has at least this many exposures.
+    cube: a night cube (nightcube.make_night_cube) covering the plan, to use
+    with the cube engine rather than computing or loading one.
+    pointing: (ra, dec) of the telescope before the plan starts, so that the
+    first pointing pays for its slew too.
+    verbose: print the night times, slews and a summary of the plan.
     """
+    if engine not in ('numpy', 'cube', 'ephem'):
+        raise ValueError('engine must be numpy, cube or ephem, not %s' %
+                         engine)
 
-    # tonightsplan = OrderedDict()
-    tonightsplan = {}
-    orig_keys = survey_centers.keys()
-    for key in orig_keys:
-        tonightsplan[key] = []
-
-    tonightsplan['airmass'] = []
-    tonightsplan['approx_time'] = []
-    tonightsplan['approx_datetime'] = []
-    tonightsplan['moon_sep'] = []
-    tonightsplan['moon_alt'] = []
-    tonightsplan['filter'] = []
-    tonightsplan['exp_time'] = []
-    tonightsplan['lst'] = []
-    tonightsplan['ha'] = []
+    tonightsplan = PlanBuffer()
 
     # Get start and end time of night
     sn = obs.date
@@ -348,60 +654,65 @@ def GetNightlyStrategy(obs, survey_centers, filters, nightfrac=1.,
     # Make sure the Sun isn't up
     sun.compute(obs)
     moon.compute(obs)
-    if sun.alt > 0:
+    if sun.alt > 0 and verbose:
         print 'WARNING: sun is up?!'
 
     # Report night start/end times
-    print 'Date: {}'.format(obs.date)
-    print 'Length of night: {} s'.format(lon)
-    print 'Start time of plan (UT): {}'.format(sn)
-    print 'End time of night (UT): {}'.format(en)
-    print 'Plan length: {} hours'.format(lon / 60. / 60.)
+    if verbose:
+        print 'Date: {}'.format(obs.date)
+        print 'Length of night: {} s'.format(lon)
+        print 'Start time of plan (UT): {}'.format(sn)
+        print 'End time of night (UT): {}'.format(en)
+        print 'Plan length: {} hours'.format(lon / 60. / 60.)
 
     for f in 'grizY':
         col = 'used_tile_{:s}'.format(f)
         survey_centers[col] = (
             survey_centers['{:s}_DONE'.format(f.capitalize())].copy())
 
-    time_elapsed = 0.0
-    filterorder = 1
-
-    while time_elapsed < lon:
-        start_obsdate = sn + time_elapsed*s_to_days
-        obs.date = start_obsdate
-
-        if obs.date > en:
-            break
-
-        sun.compute(obs)
-        moon.compute(obs)
-
-        # compute derivative of airmass for each exposure
-        airmass = np.zeros((survey_centers['RA'].size, 2), dtype='f8')
-        ha = np.zeros((survey_centers['RA'].size, 2), dtype='f8')
-        moonsep = np.zeros((survey_centers['RA'].size), dtype='f8')
-
-        for j in range(survey_centers['RA'].size):
-            tile_str = ','.join([
-                str(survey_centers['TILEID'][j]),
-                'f',
-                survey_centers['RA_STR'][j],
-                survey_centers['DEC_STR'][j],
-                '20'
-            ])
-            this_tile = ephem.readdb(tile_str)
-            moon.compute(obs)
-            this_tile.compute(obs)
-            moonsep[j] = ephem.separation((this_tile.az, this_tile.alt),
-                                          (moon.az, moon.alt))*180./np.pi
-            for k, dt in enumerate((0., s_to_days)):
-                obs.date = start_obsdate + dt
-                this_tile.compute(obs)
-                airmass[j, k] = alt2airmass(float(this_tile.alt))
-                ha[j, k] = (survey_centers['RA'][j] -
-                            np.degrees(obs.sidereal_time()))/15.
+    # Precession over a night is negligible; do it once.
+    radate, decdate = skyvec.precess(survey_centers['RA'],
+                                     survey_centers['DEC'], sn)
+    if engine == 'cube':
+        import nightcube
+        if cube is None:
+            cube = nightcube.night_cube(obs, survey_centers['RA'],
+                                        survey_centers['DEC'], sn, en,
+                                        step=cube_step, cache_dir=cache_dir)
+    else:
+        cube = None
+    start_pointing = pointing
 
-        obs.date = start_obsdate  # reset date
+    # Work remaining on each tile, one bit per filter (filter_bits), and the
+    # tiles with any work remaining.  pointing_plan clears bits as it goes,
+    # so each step only needs to look at the open tiles.
+    remaining = np.zeros(len(survey_centers['RA']), dtype='u1')
+    for f in filters:
+        remaining |= np.where(survey_centers['used_tile_{:s}'.format(f)],
+                              0, filter_bits[f]).astype('u1')
+    open_tiles = np.flatnonzero(remaining)
+
+    if neighbour_radius is not None:
+        import tileindex
+        index = tileindex.TileIndex(survey_centers['RA'],
+                                    survey_centers['DEC'])
+        index.close(remaining == 0)
+    else:
+        index = None
+
+    def score_tiles(ind, pointing):
+        """Greedy scores, exclusion mask, slew times and airmasses of tiles
+        ind at obs.date, slewing from pointing (ra, dec), or from nowhere if
+        None; excluded tiles score < -1e9."""
+        if engine == 'numpy':
+            airmass, ha, moonsep = step_ephem_numpy(
+                obs, survey_centers, radate, decdate, ind=ind)
+        elif engine == 'cube':
+            airmass, ha, moonsep = nightcube.step_ephem_cube(
+                cube, obs, survey_centers, ind=ind)
+        else:
+            airmass, ha, moonsep = step_ephem_ephem(
+                obs, survey_centers, ind=ind)
 
         # Rate of change in airmass^3 (per second)
         if not optimize_ha:
@@ -413,68 +724,147 @@ def GetNightlyStrategy(obs, survey_centers, filters, nightfrac=1.,
         exclude = (airmass[:, 0] > 5) | (moonsep < minmoonsep)
 
         # Exclude tiles that have been observed before
-        filters_done = np.ones(len(survey_centers['RA']), dtype='bool')
+        exclude = exclude | (remaining[ind] == 0)
 
-        for f in filters:
-            filters_done = (filters_done &
-                            survey_centers['used_tile_{:s}'.format(f)])
+        # Determine slew time for each possible exposure
+        if pointing is not None:
+            slew = slewtime(pointing[0], pointing[1],
+                            survey_centers['RA'][ind],
+                            survey_centers['DEC'][ind])
+        else:
+            slew = np.zeros(len(ind), dtype='f8')
 
-        exclude = exclude | filters_done
+        # Score tile based on airmass rate of change and slew time
+        return (dairmass - 0.00003*slew - 1.e10*exclude, exclude, slew,
+                airmass[:, 0])
 
-        # Bail if there's nothing left to observe
-        if np.all(exclude):
-            print 'Ran out of tiles to observe before night was done!'
-            print 'Minutes left in night: {:5.1f}'.format(
-                (lon-time_elapsed)/60.)
+    if lookahead > 0 and time_budget is not None:
+        deadline = time.time() + time_budget
+    else:
+        deadline = None
+
+    time_elapsed = 0.0
+    filterorder = 1
+
+    while time_elapsed < lon:
+        start_obsdate = sn + time_elapsed*s_to_days
+        obs.date = start_obsdate
+
+        if obs.date > en:
+            break
+
+        if (max_exposures is not None and
+                len(tonightsplan['RA']) >= max_exposures):
             break
 
-        # Determine slew time for each possible exposure
         if len(tonightsplan['RA']) > 1:
-            slew = slewtime(tonightsplan['RA'][-1], tonightsplan['DEC'][-1],
-                            survey_centers['RA'], survey_centers['DEC'])
+            pointing = (tonightsplan['RA'][-1], tonightsplan['DEC'][-1])
+        elif len(tonightsplan['RA']) == 0:
+            pointing = start_pointing
         else:
-            slew = 0
+            pointing = None
 
-        # Select tile based on airmass rate of change and slew time
-        nexttile = np.argmax(dairmass - 0.00003*slew - 1.e10*exclude)
+        # Candidate tiles: all open tiles, or with a spatial index the open
+        # tiles near the current pointing, widening the search until one of
+        # them can be observed.
+        if index is not None and pointing is not None:
+            radius = neighbour_radius
+        else:
+            radius = 180.
+        while True:
+            if radius >= 180.:
+                cand = open_tiles
+            else:
+                cand = index.query(pointing[0], pointing[1], radius)
+            score, exclude, slew, airmass = score_tiles(cand, pointing)
+            if radius >= 180. or not np.all(exclude):
+                break
+            radius *= 2.
+
+        # Bail if there's nothing left to observe
+        if np.all(exclude):
+            if verbose:
+                print 'Ran out of tiles to observe before night was done!'
+                print 'Minutes left in night: {:5.1f}'.format(
+                    (lon-time_elapsed)/60.)
+            break
+
+        nexttile = cand[np.argmax(score)]
+
+        if (lookahead > 0 and pointing is not None and
+                (deadline is None or time.time() < deadline)):
+            # Search among the best few tiles by greedy score
+            order = np.argsort(-score)[:4*beam_width]
+            pool = cand[order[score[order] > -1.e9]]
+            nexp = np.zeros(len(pool), dtype='i4')
+            duration = np.zeros(len(pool), dtype='f8')
+            for f in filters:
+                todo = (remaining[pool] & filter_bits[f]) != 0
+                nexp += todo
+                duration += todo*(exp_time_filters[f] + overheads)
+            best = lookahead_pick(score_tiles, obs, pool, nexp, duration,
+                                  survey_centers['RA'][pool],
+                                  survey_centers['DEC'][pool], pointing,
+                                  sn + lon*s_to_days, depth=lookahead,
+                                  width=beam_width,
+                                  airmass_weight=airmass_weight,
+                                  deadline=deadline)
+            if best is not None:
+                nexttile = best
+            obs.date = start_obsdate
 
         delta_t, n_exp = pointing_plan(
             tonightsplan,
-            orig_keys,
             survey_centers,
             nexttile,
             filters[::filterorder],
-            obs
+            obs,
+            cube=cube,
+            remaining=remaining
         )
 
         time_elapsed += delta_t
 
         filterorder = -filterorder
 
+        if remaining[nexttile] == 0:
+            open_tiles = open_tiles[open_tiles != nexttile]
+            if index is not None:
+                index.close(nexttile)
+
         if len(tonightsplan['RA']) > n_exp:
             slew = slewtime(tonightsplan['RA'][-1], tonightsplan['DEC'][-1],
                             tonightsplan['RA'][-n_exp-1],
                             tonightsplan['DEC'][-n_exp-1])
             time_elapsed += slew
-            if slew > 0:
+            if slew > 0 and verbose:
                 print 'time spent slewing: {:.1f}'.format(slew)
 
-    numleft = np.sum(exclude == 0)
-    print 'Plan complete, {:d} observations, {:d} remaining.'.format(
-        len(tonightsplan['RA']), numleft)
-    if np.any(np.abs(tonightsplan['ha']) > 5.25):
+    # Tiles still observable at the end of the plan, scored over all open
+    # tiles whether or not a spatial index limited the candidates.
+    obs.date = sn + time_elapsed*s_to_days
+    if verbose:
+        numleft = np.sum(~score_tiles(open_tiles, None)[1])
+        print 'Plan complete, {:d} observations, {:d} remaining.'.format(
+            len(tonightsplan['RA']), numleft)
+    if verbose and np.any(np.abs(tonightsplan['ha']) > 5.25):
         print('************************************************')
         print('WARNING: some hour angles impossible to observe!')
         print('************************************************')
         if not optimize_ha:
             print('Consider rerunning with optimize_ha!')
 
-    keys = tonightsplan.keys()
-    return np.rec.fromarrays([tonightsplan[k] for k in keys], names=keys)
+    return tonightsplan.torec()
 
 
-def pointing_plan(tonightsplan, orig_keys, survey_centers, nexttile, filters,
-                  obs):
+def pointing_plan(tonightsplan, survey_centers, nexttile, filters, obs,
+                  cube=None, remaining=None):
+    """Add exposures of nexttile in filters to tonightsplan, starting at
+    obs.date.  If a night cube is given, airmasses and moon positions are
+    interpolated from it rather than computed with pyephem.  The filter bits
+    (filter_bits) of the exposures taken are cleared in remaining."""
+    if cube is not None:
+        import nightcube
     time_elapsed = 0
     n_exp = 0
 
@@ -485,42 +875,46 @@ def pointing_plan(tonightsplan, orig_keys, survey_centers, nexttile, filters,
         n_exp += 1
 
         survey_centers['used_tile_{:s}'.format(f)][nexttile] = 1
+        if remaining is not None:
+            remaining[nexttile] &= ~filter_bits[f] & 0xff
 
-        tile_str = ','.join([
-            str(survey_centers['TILEID'][nexttile]),
-            'f',
-            survey_centers['RA_STR'][nexttile],
-            survey_centers['DEC_STR'][nexttile],
-            '20'
-        ])
-        this_tile = ephem.readdb(tile_str)
-        this_tile.compute(obs)
+        if cube is None:
+            this_tile = tile_body(survey_centers['RA'][nexttile],
+                                  survey_centers['DEC'][nexttile])
+            this_tile.compute(obs)
 
-        # Compute airmass
-        airm = alt2airmass(float(this_tile.alt))
+            # Compute airmass
+            airm = alt2airmass(float(this_tile.alt))
 
-        # Compute moon separation
-        moon.compute(obs)
-        moon_dist = ephem.separation(
-            (this_tile.az, this_tile.alt),
-            (moon.az, moon.alt)
-        )
-        moon_alt = np.degrees(moon.alt)
+            # Compute moon separation
+            moon.compute(obs)
+            moon_dist = ephem.separation(
+                (this_tile.az, this_tile.alt),
+                (moon.az, moon.alt)
+            )
+            moon_alt = np.degrees(moon.alt)
+            lst = np.degrees(obs.sidereal_time())
+        else:
+            t = float(obs.date)
+            airm = nightcube.cube_interp(cube, 'airmass', t, ind=nexttile)
+            moon_dist = np.radians(
+                nightcube.cube_interp(cube, 'moon_sep', t, ind=nexttile))
+            moon_alt = np.degrees(nightcube.cube_interp(cube, 'moon_alt', t))
+            lst = np.degrees(nightcube.cube_lst(cube, t))
 
         # Add this exposure to tonight's plan
-        for key in orig_keys:
-            tonightsplan[key].append(survey_centers[key][nexttile])
-
-        tonightsplan['exp_time'].append(exp_time_filters[f])
-        tonightsplan['approx_datetime'].append(obs.date)
-        tonightsplan['airmass'].append(airm)
-        ha = survey_centers['RA'][nexttile] - np.degrees(obs.sidereal_time())
-        tonightsplan['ha'].append(ha/15.)
-        tonightsplan['approx_time'].append(obs.date)
-        tonightsplan['filter'].append(f)
-        tonightsplan['moon_sep'].append(moon_dist)
-        tonightsplan['moon_alt'].append(moon_alt)
-        tonightsplan['lst'].append(np.degrees(obs.sidereal_time()))
+        tonightsplan.append(
+            TILEID=survey_centers['TILEID'][nexttile],
+            RA=survey_centers['RA'][nexttile],
+            DEC=survey_centers['DEC'][nexttile],
+            filter=f,
+            exp_time=exp_time_filters[f],
+            airmass=airm,
+            ha=(survey_centers['RA'][nexttile] - lst)/15.,
+            lst=lst,
+            moon_sep=moon_dist,
+            moon_alt=moon_alt,
+            approx_time=obs.date)
 
         delta_t = exp_time_filters[f] + overheads
         time_elapsed += delta_t
@@ -529,6 +923,36 @@ def pointing_plan(tonightsplan, orig_keys, survey_centers, nexttile, filters,
     return time_elapsed, n_exp
 
 
+def exposure_ephem(ra, dec, t, obs=None, step=300.):
+    """
+    Airmass, local sidereal time (radians) and moon separation (deg) of
+    exposures at J2000 ra, dec (deg) at pyephem dates t, all at once.
+
+    The sidereal time and moon position are computed with pyephem on a grid
+    of spacing step (s) spanning t (nightcube.make_night_cube) and
+    interpolated; the altitudes are then computed as in step_ephem_numpy.
+    """
+    import nightcube
+    if obs is None:
+        obs = decam
+    ra = np.asarray(ra, dtype='f8')
+    dec = np.asarray(dec, dtype='f8')
+    t = np.asarray(t, dtype='f8')
+    if len(t) == 0:
+        return np.zeros(0), np.zeros(0), np.zeros(0)
+    cube = nightcube.make_night_cube(obs, np.zeros(0), np.zeros(0),
+                                     t.min(), t.max(), step=step)
+    lst = np.interp(t, cube['time'], cube['lst']) % (2.*np.pi)
+    moon_alt = np.interp(t, cube['time'], cube['moon_alt'])
+    moon_az = np.interp(t, cube['time'], np.unwrap(cube['moon_az']))
+    radate, decdate = skyvec.precess(ra, dec, t.min())
+    alt, az = skyvec.radec2altaz(radate, decdate, lst, float(obs.lat),
+                                 temp=obs.temp, pressure=obs.pressure)
+    moonsep = gc_dist(np.degrees(az), np.degrees(alt),
+                      np.degrees(moon_az), np.degrees(moon_alt))
+    return alt2airmass(alt), lst, moonsep
+
+
 def json_to_plan(json, starttime):
     """From a set of ra, dec, exptime, filter, from json, fill in the
     approximate times of night and airmasses."""
@@ -540,40 +964,25 @@ def json_to_plan(json, starttime):
         'object': np.array([exp['object'] for exp in json])
     }
 
-    currenttime = starttime/s_to_days
-    approxtime = np.zeros(len(json), dtype='f8')
-    for i, exp in enumerate(json):
-        approxtime[i] = currenttime
-        currenttime += exp['expTime']
-        if i != 0:
-            currenttime += slewtime(float(json[i-1]['RA']),
-                                    float(json[i-1]['dec']),
-                                    float(exp['RA']), float(exp['dec']))
-        currenttime += overheads
-    airmass = np.zeros(len(json), dtype='f4')
-    moon_sep = np.zeros(len(json), dtype='f4')
-    for i, time, exp in zip(range(len(json)), approxtime, json):
-        obs = decam.copy()
-        obs.date = time*s_to_days
-        airmass[i] = radec2airmass(obs, float(exp['RA']), float(exp['dec']))
-        moon_sep[i] = radec_obj_dist(obs,
-                                     float(exp['RA']), float(exp['dec']),
-                                     ephem.Moon())
-    plan['airmass'] = airmass
+    # each exposure, its overheads and the slew to it delay the next one
+    delay = np.array([exp['expTime'] for exp in json], dtype='f8')
+    delay += overheads
+    delay[1:] += slewtime(plan['RA'][:-1], plan['DEC'][:-1],
+                          plan['RA'][1:], plan['DEC'][1:])
+    approxtime = starttime/s_to_days + np.cumsum(np.append(0., delay))[:-1]
+    airmass, lst, moon_sep = exposure_ephem(plan['RA'], plan['DEC'],
+                                            approxtime*s_to_days)
+    plan['airmass'] = airmass.astype('f4')
     plan['approx_time'] = approxtime*s_to_days
-    plan['moon_sep'] = moon_sep*np.pi/180.
+    plan['moon_sep'] = moon_sep.astype('f4')*np.pi/180.
     return plan
 
 
 def plan_hour_angles(plan):
-    obs = decam.copy()
-    ha = np.zeros(len(plan['RA']), dtype='f4')
-    for i, r, d, t in zip(range(len(plan['RA'])), plan['RA'], plan['DEC'],
-                          plan['approx_time']):
-        obs.date = t
-        lst = obs.sidereal_time()
-        ha[i] = r - np.degrees(lst)
-    return ha
+    """Hour angles (deg, RA - LST) of the exposures of plan."""
+    airmass, lst, moon_sep = exposure_ephem(plan['RA'], plan['DEC'],
+                                            plan['approx_time'])
+    return (plan['RA'] - np.degrees(lst)).astype('f4')
 
 
 def json_to_survey_centers(json):
@@ -582,8 +991,6 @@ def json_to_survey_centers(json):
     survey_centers['DEC'] = np.array([float(exp['dec']) for exp in json])
     for f in 'GRIZY':
         survey_centers[f+'_DONE'] = np.zeros(len(json), dtype='bool')
-    survey_centers['RA_STR'] = ConvertRA(survey_centers['RA'])
-    survey_centers['DEC_STR'] = ConvertDec(survey_centers['DEC'])
     survey_centers['TILEID'] = np.arange(len(json), dtype='i4')
     return survey_centers
 
@@ -705,6 +1112,40 @@ def main():
     parser.add_argument('--optimize_ha', dest='optimize_ha',
                         action='store_true',
                         help='optimize on hour angle, not airmass')
+    parser.add_argument('--engine', type=str, default='numpy',
+                        choices=['numpy', 'cube', 'ephem'],
+                        help=('compute tile airmasses with numpy (default), '
+                              'by interpolating a precomputed night cube, '
+                              'or, slowly, with pyephem for validation'))
+    parser.add_argument('--cube-step', type=float, default=30.,
+                        help='time grid spacing (s) for --engine cube')
+    parser.add_argument('--neighbour-radius', metavar='deg', type=float,
+                        default=None,
+                        help=('only consider tiles within this distance of '
+                              'the current pointing, widening as needed'))
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help=('cache night ephemerides for --engine cube in '
+                              'this directory'))
+    parser.add_argument('--lookahead', metavar='N', type=int, default=0,
+                        help=('choose pointings by a beam search over the '
+                              'next N pointings, and compare with the '
+                              'greedy plan'))
+    parser.add_argument('--beam-width', type=int, default=5,
+                        help='number of sequences kept with --lookahead')
+    parser.add_argument('--time-budget', metavar='s', type=float,
+                        default=None,
+                        help=('wall clock limit on the --lookahead search; '
+                              'plan greedily after it'))
+    parser.add_argument('--airmass-weight', metavar='s', type=float,
+                        default=100.,
+                        help=('cost with --lookahead of one unit of airmass '
+                              'per exposure, in seconds of slewing'))
+    parser.add_argument('--optimize-route', action='store_true',
+                        help=('reorder the pointings of the plan to reduce '
+                              'slewing; see routeopt'))
+    parser.add_argument('--route-airmass', type=float, default=2.,
+                        help=('airmass limit for reordered pointings with '
+                              '--optimize-route'))
 
     args = parser.parse_args()
 
@@ -725,9 +1166,28 @@ def main():
     else:
         obs.date = args.night + ' ' + args.time
 
+    start = obs.date
+    kw = dict(minmoonsep=args.moonsep, optimize_ha=args.optimize_ha,
+              engine=args.engine, cube_step=args.cube_step,
+              cache_dir=args.cache_dir,
+              neighbour_radius=args.neighbour_radius)
     plan = GetNightlyStrategy(obs, tilestable[1], args.filters, args.nightfrac,
-                              minmoonsep=args.moonsep,
-                              optimize_ha=args.optimize_ha)
+                              lookahead=args.lookahead,
+                              beam_width=args.beam_width,
+                              time_budget=args.time_budget,
+                              airmass_weight=args.airmass_weight, **kw)
+    if args.lookahead > 0:
+        obs.date = start
+        greedy = GetNightlyStrategy(obs, tilestable[1], args.filters,
+                                    args.nightfrac, **kw)
+        for name, p in (('greedy', greedy), ('lookahead', plan)):
+            print('{:<10s} {nexp:5d} exposures, {slew:8.1f} s slewing, '
+                  'mean airmass {airmass:.3f}'.format(name, **plan_stats(p)))
+    if args.optimize_route:
+        import routeopt
+        plan = routeopt.optimize_plan(plan, obs=decam,
+                                      airmass_limit=args.route_airmass,
+                                      minmoonsep=args.moonsep)
     plot_plan(plan, args.night, filename=args.outfile)
     WriteJSON(plan, args.outfile, chunks=args.chunks)
     write_plan_schedule(plan, args.outfile)
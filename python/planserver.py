@@ -0,0 +1,295 @@
+"""
+Planning service: keeps the tile table and the night ephemerides in memory
+and answers requests for the next exposures from the current tile status.
+
+When weather or a fault disrupts the night, rather than re-running
+nightstrat.py, which reloads everything and replans the night from scratch,
+run
+
+python planserver.py decaps-tiles.fits gr --port 8642
+
+and POST to /next a JSON dictionary like
+
+{"time": "2016/3/14 03:12:00", "ra": 123.4, "dec": -25.1, "n": 10,
+ "completed": ["DECaPS_4453_g", "DECaPS_4453_r"]}
+
+All keys are optional: time (UT) defaults to the planner clock, ra, dec (the
+current pointing) to none, n to 10 and completed to no new exposures.
+Completed exposures are given by object name, or as exposure dictionaries
+from the planner's replies.  The reply is a list of the next n exposures in
+the format of nightstrat.WriteJSON.  GET /status gives the number of tiles
+still to do in each filter.
+
+With --fake-time the planner runs on a FakeClock starting at that time,
+which POST /clock {"time": ...} sets, for testing.
+"""
+
+import json
+
+import numpy as np
+import ephem
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import nightstrat
+import nightcube
+
+
+class SystemClock(object):
+    """Clock giving the current time."""
+
+    def now(self):
+        return ephem.now()
+
+
+class FakeClock(object):
+    """Clock for testing, stopped at date until set or advanced."""
+
+    def __init__(self, date):
+        self.date = ephem.Date(date)
+
+    def now(self):
+        return self.date
+
+    def set(self, date):
+        self.date = ephem.Date(date)
+
+    def advance(self, seconds):
+        self.date = ephem.Date(self.date + seconds*nightstrat.s_to_days)
+
+
+def parse_object(obj):
+    """TILEID and filter of an exposure, given as an object name
+    DECaPS_<TILEID>_<filter> or a dictionary with an 'object' key."""
+    if isinstance(obj, dict):
+        obj = obj['object']
+    prefix, tileid, filt = obj.rsplit('_', 2)
+    return int(tileid), str(filt)
+
+
+class Planner(object):
+    """
+    Plans the next exposures for a survey (as from nightstrat.readTilesTable),
+    keeping the night cube of the current night in memory.
+
+    kw are passed to nightstrat.GetNightlyStrategy.
+    """
+
+    def __init__(self, survey, filters, clock=None, obs=None, cube_step=30.,
+                 **kw):
+        self.survey = survey
+        self.filters = filters
+        self.clock = clock if clock is not None else SystemClock()
+        self.obs = obs if obs is not None else nightstrat.decam
+        self.cube_step = cube_step
+        self.kw = kw
+        self.order = np.argsort(survey['TILEID'])
+        self.night = None
+        self.cube = None
+
+    def night_bounds(self, t):
+        """Start and end of the night in progress at t, or of the next one
+        if t is during the day."""
+        obs = self.obs.copy()
+        # a second late, so that at sunset this is the night starting now
+        obs.date = t + nightstrat.s_to_days
+        sun = ephem.Sun()
+        start = obs.previous_setting(sun)
+        if obs.previous_rising(sun) > start:
+            start = obs.next_setting(sun)
+        obs.date = start
+        return start, obs.next_rising(sun)
+
+    def night_cube(self, start, end):
+        """Night cube for the night starting at start, kept until another
+        night is asked for."""
+        if self.night is None or abs(start - self.night) > 0.01:
+            self.cube = None  # free the old one first
+            self.cube = nightcube.make_night_cube(
+                self.obs, self.survey['RA'], self.survey['DEC'], start, end,
+                step=self.cube_step)
+            self.night = start
+        return self.cube
+
+    def mark_done(self, completed):
+        """Mark completed exposures done; returns the number of them found
+        in the survey."""
+        tileid = self.survey['TILEID']
+        nfound = 0
+        for obj in completed:
+            tile, filt = parse_object(obj)
+            i = np.searchsorted(tileid, tile, sorter=self.order)
+            if i == len(tileid) or tileid[self.order[i]] != tile:
+                continue
+            col = '{:s}_DONE'.format(filt.capitalize())
+            if col not in self.survey:
+                continue
+            self.survey[col][self.order[i]] = 1
+            nfound += 1
+        return nfound
+
+    def status(self):
+        """Number of tiles still to do in each filter."""
+        return dict((f, int(np.sum(
+            self.survey['{:s}_DONE'.format(f.capitalize())] == 0)))
+            for f in self.filters)
+
+    def next_exposures(self, time=None, pointing=None, completed=(), n=10):
+        """
+        The next n exposures, as a list of dictionaries in the format of
+        nightstrat.WriteJSON.
+
+        Inputs:
+            time       UT date at which to start (default: clock time)
+            pointing   (ra, dec) of the telescope now, if known
+            completed  exposures done since the last request (see
+                       parse_object)
+            n          number of exposures
+        """
+        self.mark_done(completed)
+        if time is None:
+            t = self.clock.now()
+        else:
+            t = ephem.Date(str(time))
+        start, end = self.night_bounds(t)
+        cube = self.night_cube(start, end)
+        obs = self.obs.copy()
+        obs.date = max(t, start)
+        plan = nightstrat.GetNightlyStrategy(
+            obs, self.survey, self.filters, engine='cube', cube=cube,
+            max_exposures=n, pointing=pointing, verbose=False, **self.kw)
+        return nightstrat.plan_to_json(plan[:n])
+
+
+def make_handler(planner):
+    """Request handler class serving planner."""
+
+    class PlanHandler(BaseHTTPRequestHandler):
+
+        def send_json(self, obj):
+            body = json.dumps(obj, indent=2, separators=(',', ': '))
+            body = body.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def read_json(self):
+            length = int(self.headers.get('Content-Length', 0))
+            body = self.rfile.read(length).decode('utf-8')
+            return json.loads(body) if body else {}
+
+        def do_GET(self):
+            if self.path == '/status':
+                self.send_json(planner.status())
+            else:
+                self.send_error(404)
+
+        def do_POST(self):
+            try:
+                req = self.read_json()
+                if self.path == '/next':
+                    if 'ra' in req:
+                        pointing = (float(req['ra']), float(req['dec']))
+                    else:
+                        pointing = None
+                    reply = planner.next_exposures(
+                        time=req.get('time'), pointing=pointing,
+                        completed=req.get('completed', []),
+                        n=int(req.get('n', 10)))
+                elif (self.path == '/clock' and
+                      isinstance(planner.clock, FakeClock)):
+                    planner.clock.set(str(req['time']))
+                    reply = {'time': str(planner.clock.now())}
+                else:
+                    self.send_error(404)
+                    return
+            except (ValueError, KeyError, TypeError) as e:
+                self.send_error(400, str(e))
+                return
+            self.send_json(reply)
+
+    return PlanHandler
+
+
+def serve(planner, host='127.0.0.1', port=8642):
+    """Serve planner over HTTP until interrupted."""
+    server = HTTPServer((host, port), make_handler(planner))
+    print('Planning service on http://{:s}:{:d}'.format(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Serve plans for the next exposures.',
+        epilog='EXAMPLE: %(prog)s decaps-tiles.fits gr --port 8642')
+    parser.add_argument('tilefile', type=str, help='file name of tiles')
+    parser.add_argument('filters', type=str, help='filters to run')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='address to listen on')
+    parser.add_argument('--port', type=int, default=8642,
+                        help='port to listen on')
+    parser.add_argument('--fake-time', type=str, default=None,
+                        help=('run on a fake clock starting at this UT '
+                              'time, set with POST /clock'))
+    parser.add_argument('--pass', type=int, default=1, dest='skypass',
+                        help='Specify pass (dither) number (1,2, or 3); '
+                        '0 implies all passes.')
+    parser.add_argument('--expand-footprint', action='store_true',
+                        help='Use tiles outside nominal footprint')
+    parser.add_argument(
+        '--rd-bounds', metavar='deg', type=float, nargs=4, default=None,
+        help=('use only tiles in ra/dec range, specified as '
+              '(ramin, ramax, decmin, decmax)'))
+    parser.add_argument(
+        '--lb-bounds', metavar='deg', type=float, nargs=4, default=None,
+        help=('use only tiles in lb range, specified as '
+              '(lmin, lmax, bmin, bmax)'))
+    parser.add_argument('--moonsep', type=float, default=40.,
+                        help='minimum moon separation to consider')
+    parser.add_argument('--weatherfile', type=str, default='',
+                        help=('mark exposures with bad quality from this '
+                              'file as not yet done'))
+    parser.add_argument('--optimize_ha', dest='optimize_ha',
+                        action='store_true',
+                        help='optimize on hour angle, not airmass')
+    parser.add_argument('--cube-step', type=float, default=30.,
+                        help='time grid spacing (s) of the night cube')
+    parser.add_argument('--neighbour-radius', metavar='deg', type=float,
+                        default=None,
+                        help=('only consider tiles within this distance of '
+                              'the current pointing, widening as needed'))
+
+    args = parser.parse_args()
+
+    tiles, survey = nightstrat.readTilesTable(
+        args.tilefile,
+        expand_footprint=args.expand_footprint,
+        rdbounds=args.rd_bounds,
+        lbbounds=args.lb_bounds,
+        skypass=args.skypass,
+        weatherfile=args.weatherfile
+    )
+    if args.fake_time is not None:
+        clock = FakeClock(args.fake_time)
+    else:
+        clock = SystemClock()
+    planner = Planner(survey, args.filters, clock=clock,
+                      cube_step=args.cube_step, minmoonsep=args.moonsep,
+                      optimize_ha=args.optimize_ha,
+                      neighbour_radius=args.neighbour_radius)
+    serve(planner, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
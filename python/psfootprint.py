@@ -1,52 +1,197 @@
+"""
+Build the DECaPS footprint columns of the tile table.
+
+The footprint is a list of regions, each setting one bit of IN_DECAPS for
+the tiles in it.  A region is a dictionary like
+
+{"name": "pilot", "bit": 0, "lbounds": [[240, 365], [-5, 5]],
+ "bbounds": [-4, 4], "extend": true}
+
+of which all the criteria given must hold:
+    lbounds   list of (lmin, lmax) ranges in galactic l (deg, in [0, 360)),
+              any of which may hold
+    bbounds   (bmin, bmax) range in galactic b (deg)
+    polygon   list of (l, b) vertices (deg) of a polygon in l, b
+    ebvmin, ebvmax
+              range of EBV_MED
+and with extend, tiles in any pointing with a tile in the region are
+included.  The default regions are the pilot footprint (bit 0) and the
+expanded footprint (bit 1) used by nightstrat.
+
+python psfootprint.py decam-tiles.fits decaps-tiles.fits --regions regions.json
+"""
+
+import json
 import numpy
 import pdb
 from astropy.io import fits
-from lsd.builtins.misc import galequ, equgal
-from matplotlib.mlab import rec_append_fields
+from skyvec import equgal
+import tilefile
 
 defaulttilefile = ('/n/home13/schlafly/decals/observing/trunk/obstatus/'
                    'decam-tiles_obstatus.fits')
 
+default_regions = [
+    {'name': 'pilot', 'bit': 0, 'lbounds': [[240, 365], [-5, 5]],
+     'bbounds': [-4, 4], 'extend': True},
+    {'name': 'expanded', 'bit': 1, 'lbounds': [[240, 365], [-5, 5]],
+     'bbounds': [-10, 10]},
+]
+
+# columns added to the tile list if missing, as (name, dtype)
+status_columns = [('i_done', 'i4'), ('y_done', 'i4'), ('i_expnum', 'i4'),
+                  ('y_expnum', 'i4'), ('in_decaps', 'i4'),
+                  ('i_date', 'S10'), ('y_date', 'S10')]
+
 
 def extend_footprint_to_matches(tiles, infootprint):
     # collect any pointings where not all three landed within the footprint
-    npointings = len(tiles) / 3
+    npointings = len(tiles) // 3
+    tileno = tiles['tileid'] % npointings
+    pointinginfootprint = numpy.zeros(npointings, dtype='bool')
+    pointinginfootprint[tileno[infootprint]] = True
+    return infootprint | pointinginfootprint[tileno]
+
+
+def extend_footprint_to_matches_loop(tiles, infootprint):
+    # original O(N^2) version, for benchmark_extend_footprint
+    npointings = len(tiles) // 3
     tileno = tiles['tileid'] % npointings
     tilenoinpointing = tileno[infootprint]
     for tileno0 in tilenoinpointing:
         infootprint = infootprint | (tileno == tileno0)
-        # O(N^2), easy to speed up if necessary
     return infootprint
 
 
-def make_footprint(tilefile=defaulttilefile):
-    lbound1 = [240, 365]
-    lbound2 = [-5, 5]
-    bbound = [-4, 4]
+def benchmark_extend_footprint(tilefile=defaulttilefile, bbound=(-4, 4)):
+    """Time extend_footprint_to_matches against the loop version on the
+    tiles of tilefile within |b| limits bbound, and check they agree."""
+    import time
+    tiles = fits.getdata(tilefile)
+    lt, bt = equgal(tiles['ra'], tiles['dec'])
+    infootprint = (bt > bbound[0]) & (bt < bbound[1])
+    t0 = time.time()
+    mloop = extend_footprint_to_matches_loop(tiles, infootprint)
+    t1 = time.time()
+    mfast = extend_footprint_to_matches(tiles, infootprint)
+    t2 = time.time()
+    if not numpy.array_equal(mloop, mfast):
+        raise ValueError('extend_footprint_to_matches disagrees with loop!')
+    print('%d tiles, %d in footprint, %d after extension: loop %.3f s, '
+          'vectorized %.5f s' % (len(tiles), numpy.sum(infootprint),
+                                 numpy.sum(mfast), t1-t0, t2-t1))
+    return t1-t0, t2-t1
+
+
+def in_polygon(l, b, vertices):
+    """Whether points l, b (deg) are inside the polygon with vertices
+    [(l, b), ...].  All l are wrapped to within 180 deg of the first
+    vertex, so the polygon may straddle l = 0."""
+    vl, vb = numpy.array(vertices, dtype='f8').T
+    l = (l - vl[0] + 180.) % 360. + vl[0] - 180.
+    vl = (vl - vl[0] + 180.) % 360. + vl[0] - 180.
+    inside = numpy.zeros(len(l), dtype='bool')
+    for i in range(len(vl)):
+        l0, b0 = vl[i-1], vb[i-1]
+        l1, b1 = vl[i], vb[i]
+        if b0 == b1:
+            continue
+        cross = (b0 > b) != (b1 > b)
+        lcross = l0 + (b - b0) * (l1 - l0) / (b1 - b0)
+        inside ^= cross & (l < lcross)
+    return inside
+
+
+def region_mask(region, lt, bt, ebv):
+    """Mask of the tiles at galactic lt, bt with EBV_MED ebv in region,
+    before extending to whole pointings."""
+    m = numpy.ones(len(lt), dtype='bool')
+    if 'lbounds' in region:
+        ml = numpy.zeros(len(lt), dtype='bool')
+        for lmin, lmax in region['lbounds']:
+            ml |= (lt > lmin) & (lt < lmax)
+        m &= ml
+    if 'bbounds' in region:
+        bmin, bmax = region['bbounds']
+        m &= (bt > bmin) & (bt < bmax)
+    if 'polygon' in region:
+        m &= in_polygon(lt, bt, region['polygon'])
+    if 'ebvmin' in region:
+        m &= ebv >= region['ebvmin']
+    if 'ebvmax' in region:
+        m &= ebv <= region['ebvmax']
+    return m
+
+
+def add_columns(tiles, columns):
+    """Copy of tiles with names in lower case and the columns (name, dtype)
+    it lacks added as zeros, allocated at once."""
+    names = [n.lower() for n in tiles.dtype.names]
+    dtype = [(n, tiles.dtype[i]) for i, n in enumerate(names)]
+    dtype += [(n, d) for n, d in columns if n not in names]
+    out = numpy.zeros(len(tiles), dtype=dtype)
+    for name, newname in zip(tiles.dtype.names, names):
+        out[newname] = tiles[name]
+    return out.view(numpy.recarray)
+
+
+def make_footprint(tilefile=defaulttilefile, regions=None, outfile=None):
+    """
+    Tile list of tilefile with the status columns added and in_decaps set
+    from regions (default default_regions), as a record array with column
+    names in lower case.  The result is written to the tile status file
+    outfile if given.
+    """
+    if regions is None:
+        regions = default_regions
     tiles = fits.getdata(tilefile)
     lt, bt = equgal(tiles['ra'], tiles['dec'])
-    mpilot = ((bt > bbound[0]) & (bt < bbound[1]) &
-              (
-                  (lt > lbound1[0]) & (lt < lbound1[1]) |
-                  (lt > lbound2[0]) & (lt < lbound2[1])
-              ))
-    mpilot = extend_footprint_to_matches(tiles, mpilot)
-    zeros = numpy.zeros(len(tiles), dtype='i4')
-    tiles = rec_append_fields(tiles, ['i_done', 'y_done', 'i_expnum',
-                                      'y_expnum', 'in_decaps'],
-                              [zeros.copy() for i in xrange(5)])
-    zeros = numpy.zeros(len(tiles), dtype='S10')
-    tiles = rec_append_fields(tiles, ['i_date', 'y_date'],
-                              [zeros.copy() for i in xrange(2)])
-    tiles['in_decaps'][mpilot] |= 2**0
-    lbound1 = [240, 365]
-    lbound2 = [-5, 5]
-    bbound = [-10, 10]
-    mall = ((bt > bbound[0]) & (bt < bbound[1]) &
-            (
-                (lt > lbound1[0]) & (lt < lbound1[1]) |
-                (lt > lbound2[0]) & (lt < lbound2[1])
-            ))
-    tiles['in_decaps'][mall] |= 2**1
-    tiles.dtype.names = [n.lower() for n in tiles.dtype.names]
+    if any('ebvmin' in r or 'ebvmax' in r for r in regions):
+        ebv = tiles['ebv_med']
+    else:
+        ebv = None
+    tiles = add_columns(tiles, status_columns)
+    in_decaps = numpy.zeros(len(tiles), dtype='i4')
+    for region in regions:
+        m = region_mask(region, lt, bt, ebv)
+        if region.get('extend', False):
+            m = extend_footprint_to_matches(tiles, m)
+        in_decaps[m] |= 2**region['bit']
+    tiles['in_decaps'] = in_decaps
+    if outfile is not None:
+        write_footprint(tiles, outfile)
     return tiles
+
+
+def write_footprint(tiles, outfile):
+    """Write tiles from make_footprint as the tile status file outfile."""
+    tilefile.compact(tiles, outfile)
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Build the tile status file with a DECaPS footprint.',
+        epilog=('EXAMPLE: %(prog)s decam-tiles.fits decaps-tiles.fits '
+                '--regions regions.json'))
+    parser.add_argument('tilefile', type=str, help='DECam tile list to read')
+    parser.add_argument('outfile', type=str,
+                        help='tile status file to write')
+    parser.add_argument('--regions', type=str, default=None,
+                        help=('JSON file listing footprint regions; default '
+                              'the pilot and expanded footprints'))
+    args = parser.parse_args()
+    regions = None
+    if args.regions is not None:
+        with open(args.regions) as f:
+            regions = json.load(f)
+    tiles = make_footprint(args.tilefile, regions=regions,
+                           outfile=args.outfile)
+    for region in (regions if regions is not None else default_regions):
+        n = numpy.sum((tiles['in_decaps'] & 2**region['bit']) != 0)
+        print('%s (bit %d): %d tiles' % (region.get('name', ''),
+                                         region['bit'], n))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+"""
+Reorder the pointings of a night plan to reduce slewing.
+
+GetNightlyStrategy picks one pointing at a time, so its plans contain slews
+that another ordering of the same pointings would avoid.  optimize_plan
+improves the order of the pointings of a plan (runs of exposures of one
+tile) with the travelling salesman moves 2-opt (reverse a stretch of the
+route) and Or-opt (move a run of up to three pointings elsewhere).  A move
+is kept only if it shortens the total slew time and every pointing stays in
+its visibility window: airmass, hour angle and moon separation limits,
+tabulated on a time grid with nightcube.make_night_cube.  The plan is then
+rebuilt at the new times with nightstrat.pointing_plan, so that it is an
+ordinary plan for WriteJSON.
+
+The exposures themselves are unchanged, so the plan finishes earlier by the
+slew time saved.
+"""
+
+import numpy as np
+
+import nightstrat
+import nightcube
+
+
+def pointing_bounds(plan):
+    """Indices in plan of the first exposure of each pointing (run of
+    exposures of one tile), followed by len(plan)."""
+    tileid = plan['TILEID']
+    new = np.ones(len(tileid), dtype='bool')
+    new[1:] = tileid[1:] != tileid[:-1]
+    return np.append(np.flatnonzero(new), len(tileid))
+
+
+def slew_matrix(ra, dec):
+    """
+    Slew times (s) between all pairs of positions ra, dec (deg).
+
+    An extra last row and column of zeros stands for 'no pointing', the
+    ends of the route.
+    """
+    n = len(ra)
+    slew = np.zeros((n+1, n+1), dtype='f8')
+    slew[:n, :n] = nightstrat.slewtime(ra[:, None], dec[:, None],
+                                       ra[None, :], dec[None, :])
+    return slew
+
+
+def window_hour_angle(ra, lst):
+    """Hour angle (hours, wrapped to [-12, 12)) of ra (deg) at lst (deg)."""
+    return ((ra - lst + 180.) % 360. - 180.)/15.
+
+
+class Route(object):
+    """
+    Pointings of a plan, with their durations, slew times and visibility.
+
+    visible[i, p] says whether pointing p is within its limits at grid time
+    time[i]; a pointing may be observed from t0 to t1 if it is visible at
+    every grid time from the one before t0 to the one after t1.
+    """
+
+    def __init__(self, plan, obs, airmass_limit=2., ha_limit=5.25,
+                 minmoonsep=40., step=60.):
+        self.bounds = pointing_bounds(plan)
+        first = self.bounds[:-1]
+        self.n = len(first)
+        self.tileid = plan['TILEID'][first]
+        self.ra = plan['RA'][first]
+        self.dec = plan['DEC'][first]
+        self.filters = [''.join(plan['filter'][i0:i1])
+                        for i0, i1 in zip(first, self.bounds[1:])]
+        cost = plan['exp_time'] + nightstrat.overheads
+        self.duration = np.add.reduceat(cost, first).astype('f8')
+        self.slew = slew_matrix(self.ra, self.dec)
+        self.t_start = float(plan['approx_time'][0])
+
+        order = np.arange(self.n)
+        t_end = self.t_start + (self.total(order) + np.sum(self.duration) +
+                                step) * nightstrat.s_to_days
+        cube = nightcube.make_night_cube(obs, self.ra, self.dec,
+                                         self.t_start, t_end, step=step)
+        self.step = step
+        self.time = cube['time']
+        airmass = cube['airmass']
+        ha = np.abs(window_hour_angle(self.ra[None, :],
+                                      np.degrees(cube['lst'])[:, None]))
+        moonsep = cube['moon_sep']
+
+        # Relax the limits for pointings that the plan already observes
+        # outside them, so that the plan as given is valid.
+        i0, i1 = self.grid_range(self.start_times(order))
+        amax = np.zeros(self.n)
+        hmax = np.zeros(self.n)
+        mmin = np.zeros(self.n)
+        for p in range(self.n):
+            amax[p] = np.max(airmass[i0[p]:i1[p]+1, p])
+            hmax[p] = np.max(ha[i0[p]:i1[p]+1, p])
+            mmin[p] = np.min(moonsep[i0[p]:i1[p]+1, p])
+        self.visible = ((airmass <= np.maximum(airmass_limit, amax)) &
+                        (ha <= np.maximum(ha_limit, hmax)) &
+                        (moonsep >= np.minimum(minmoonsep, mmin)))
+        # cumulative count of invisible grid times, for interval checks
+        self.hidden = np.zeros((len(self.time)+1, self.n), dtype='i4')
+        np.cumsum(~self.visible, axis=0, out=self.hidden[1:])
+
+    def total(self, order):
+        """Total slew time (s) of the route order."""
+        return np.sum(self.slew[order[:-1], order[1:]])
+
+    def start_times(self, order):
+        """Start times (pyephem dates) of the pointings, indexed by
+        pointing, when observed in the given order."""
+        steps = (self.duration[order[:-1]] +
+                 self.slew[order[:-1], order[1:]])
+        start = np.zeros(self.n)
+        start[order] = self.t_start + np.append(
+            0., np.cumsum(steps)) * nightstrat.s_to_days
+        return start
+
+    def grid_range(self, start):
+        """First and last grid index covering each pointing observed from
+        start."""
+        end = start + self.duration * nightstrat.s_to_days
+        x0 = (start - self.time[0]) * nightstrat.days_to_s / self.step
+        x1 = (end - self.time[0]) * nightstrat.days_to_s / self.step
+        i0 = np.clip(np.floor(x0).astype('i8'), 0, len(self.time)-1)
+        i1 = np.clip(np.ceil(x1).astype('i8'), 0, len(self.time)-1)
+        return i0, i1
+
+    def feasible(self, order):
+        """Whether every pointing is within its limits when observed in the
+        given order."""
+        start = self.start_times(order)
+        if start.max() > self.time[-1]:
+            return False
+        i0, i1 = self.grid_range(start)
+        p = np.arange(self.n)
+        return not np.any(self.hidden[i1+1, p] - self.hidden[i0, p])
+
+
+def two_opt(route, order, max_segment):
+    """One pass of 2-opt moves; returns the new order and number of moves."""
+    n, s, nowhere = route.n, route.slew, route.n
+    nmove = 0
+    for i in range(n-1):
+        for j in range(i+1, min(n, i+max_segment)):
+            a = order[i-1] if i > 0 else nowhere
+            d = order[j+1] if j+1 < n else nowhere
+            b, c = order[i], order[j]
+            delta = s[a, c] + s[b, d] - s[a, b] - s[c, d]
+            if delta >= -1e-6:
+                continue
+            new = order.copy()
+            new[i:j+1] = order[i:j+1][::-1]
+            if route.feasible(new):
+                order = new
+                nmove += 1
+    return order, nmove
+
+
+def or_opt(route, order, max_segment, max_length=3):
+    """One pass of Or-opt moves; returns the new order and number of
+    moves."""
+    n, s, nowhere = route.n, route.slew, route.n
+    nmove = 0
+    for length in range(1, max_length+1):
+        for i in range(n-length+1):
+            seg = order[i:i+length]
+            a = order[i-1] if i > 0 else nowhere
+            b = order[i+length] if i+length < n else nowhere
+            removed = s[a, seg[0]] + s[seg[-1], b] - s[a, b]
+            rest = np.concatenate([order[:i], order[i+length:]])
+            best = None
+            for k in range(max(0, i-max_segment),
+                           min(len(rest), i+max_segment)+1):
+                if k == i:
+                    continue
+                u = rest[k-1] if k > 0 else nowhere
+                v = rest[k] if k < len(rest) else nowhere
+                for piece in (seg, seg[::-1]):
+                    delta = (s[u, piece[0]] + s[piece[-1], v] - s[u, v] -
+                             removed)
+                    if delta < -1e-6 and (best is None or delta < best[0]):
+                        best = (delta, k, piece)
+            if best is None:
+                continue
+            delta, k, piece = best
+            new = np.concatenate([rest[:k], piece, rest[k:]])
+            if route.feasible(new):
+                order = new
+                nmove += 1
+    return order, nmove
+
+
+def rebuild_plan(plan, route, order, obs):
+    """Plan with the pointings of plan observed in the given order."""
+    survey = {'TILEID': route.tileid, 'RA': route.ra, 'DEC': route.dec}
+    for f in 'grizY':
+        survey['used_tile_{:s}'.format(f)] = np.array(
+            [f not in filt for filt in route.filters], dtype='i4')
+    obs = obs.copy()
+    newplan = nightstrat.PlanBuffer(len(plan))
+    t = route.t_start
+    last = None
+    for k, p in enumerate(order):
+        filters = route.filters[p]
+        # keep the filter of the previous exposure if we can
+        if last is not None and filters[0] != last and filters[-1] == last:
+            filters = filters[::-1]
+        obs.date = t
+        delta_t, n_exp = nightstrat.pointing_plan(newplan, survey, p,
+                                                  filters, obs)
+        last = filters[-1]
+        if k+1 < len(order):
+            delta_t += route.slew[p, order[k+1]]
+        t += delta_t * nightstrat.s_to_days
+    return newplan.torec()
+
+
+def optimize_plan(plan, obs=None, airmass_limit=2., ha_limit=5.25,
+                  minmoonsep=40., max_segment=30, max_passes=10, step=60.):
+    """
+    Reorder the pointings of plan to shorten its total slew time.
+
+    Inputs:
+        plan           plan from nightstrat.GetNightlyStrategy
+        obs            observer (default nightstrat.decam)
+        airmass_limit  pointings are kept below this airmass, or below
+                       their airmass in plan if higher
+        ha_limit       |hour angle| limit (hours), likewise
+        minmoonsep     moon separation limit (deg), likewise
+        max_segment    moves only shift pointings by up to this many places
+        max_passes     maximum number of passes of 2-opt and Or-opt moves
+        step           time grid spacing (s) for the visibility windows
+    Output:
+        the reordered plan.
+    """
+    if len(plan) < 2:
+        return plan
+    if obs is None:
+        obs = nightstrat.decam
+    route = Route(plan, obs, airmass_limit=airmass_limit, ha_limit=ha_limit,
+                  minmoonsep=minmoonsep, step=step)
+    order = np.arange(route.n)
+    before = route.total(order)
+    nmove = 0
+    for i in range(max_passes):
+        order, n2 = two_opt(route, order, max_segment)
+        order, n3 = or_opt(route, order, max_segment)
+        nmove += n2 + n3
+        if n2 + n3 == 0:
+            break
+    after = route.total(order)
+    print('Route optimization: {:d} moves, slewing {:.1f} -> {:.1f} s, '
+          '{:.1f} minutes saved.'.format(nmove, before, after,
+                                         (before - after)/60.))
+    return rebuild_plan(plan, route, order, obs)
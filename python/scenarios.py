@@ -0,0 +1,164 @@
+"""
+Run campaign simulations for many strategies and weather realizations in
+parallel.
+
+Scenarios are read from a JSON file holding a list of dictionaries, e.g.
+
+[
+  {"name": "b4", "lbbounds": [-180, 180, -4, 4]},
+  {"name": "b5", "expand_footprint": true, "lbbounds": [-180, 180, -5, 5],
+   "minmoonsep": 30, "nightloss": 0.3}
+]
+
+where the keys are arguments of nightstrat.select_survey, of
+nightstrat.GetNightlyStrategy and of campaign.simulate.  Each scenario is
+simulated for several random seeds (weather realizations) on a pool of
+processes.  The tile table is read once, and saved as one .npy file per
+column in a temporary directory (in /dev/shm where available), which the
+workers memory map read-only rather than receiving pickled copies.
+
+python scenarios.py 2016-03-13 2016-03-20 decaps-tiles.fits gr \\
+    scenarios.json results.txt --realizations 20
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import multiprocessing
+from collections import OrderedDict
+
+import numpy as np
+
+import nightstrat
+import campaign
+import tilefile
+
+select_keys = ['expand_footprint', 'rdbounds', 'lbbounds', 'skypass']
+simulate_keys = ['badfile', 'nightloss', 'nightfrac', 'minmoonsep',
+                 'optimize_ha', 'engine', 'cube_step', 'cache_dir',
+                 'neighbour_radius', 'lookahead', 'beam_width', 'time_budget',
+                 'airmass_weight']
+
+result_dtype = [('name', 'S40'), ('seed', 'i4'), ('ntile', 'i4'),
+                ('nexp', 'i4'), ('nlost', 'i4'), ('nempty', 'i4'),
+                ('completion', 'f8')]
+
+
+def share_tiles(tiles, dirname):
+    """Save the columns of tiles to dirname for load_shared_tiles."""
+    tilefile.save_store(tiles, dirname)
+
+
+def load_shared_tiles(dirname):
+    """Memory map the tile columns saved by share_tiles, read-only."""
+    return tilefile.TileStore(dirname)
+
+
+def check_scenarios(scenarios):
+    """Raise ValueError if a scenario has a key that would be ignored, so
+    that a misspelled key does not silently run the default."""
+    known = set(['name'] + select_keys + simulate_keys)
+    for i, scenario in enumerate(scenarios):
+        unknown = sorted(set(scenario) - known)
+        if unknown:
+            raise ValueError('unknown keys in scenario %s: %s' % (
+                scenario.get('name', i), ', '.join(unknown)))
+
+
+def run_scenario(tiledir, nights, filters, scenario, seed):
+    """Simulate one scenario and seed; returns a row of result_dtype."""
+    tiles = load_shared_tiles(tiledir)
+    survey = nightstrat.select_survey(
+        tiles, **dict((k, scenario[k]) for k in select_keys if k in scenario))
+    kw = dict((k, scenario[k]) for k in simulate_keys if k in scenario)
+    summary = campaign.simulate(survey, nights, filters, seed=seed,
+                                verbose=False, **kw)
+    return (scenario['name'], seed, len(survey['TILEID']),
+            np.sum(summary['nexp']), np.sum(summary['nlost']),
+            np.sum(summary['nexp'] == 0), summary['completion'][-1])
+
+
+def run_scenarios(tiles, nights, filters, scenarios, realizations=1,
+                  workers=None):
+    """
+    Simulate every scenario for seeds 0 ... realizations-1 on a pool of
+    workers processes (default: one per core).
+
+    Returns a record array of result_dtype, one row per scenario and seed.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    shmdir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    tiledir = tempfile.mkdtemp(prefix='decam-tiles-', dir=shmdir)
+    try:
+        share_tiles(tiles, tiledir)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(run_scenario, tiledir, nights, filters,
+                                   scenario, seed)
+                       for scenario in scenarios
+                       for seed in range(realizations)]
+            rows = [future.result() for future in futures]
+    finally:
+        shutil.rmtree(tiledir, ignore_errors=True)
+    return np.rec.fromrecords(rows, dtype=result_dtype)
+
+
+def write_results(results, fname=None):
+    lines = ['# name                 seed  ntile   nexp  nlost  nempty  '
+             'completion']
+    for row in results:
+        lines.append('  {:<20s} {:4d}  {:5d}  {:5d}  {:5d}  {:6d}  '
+                     '{:10.4f}'.format(*row))
+    lines.append('# name                 mean completion  std')
+    for name in OrderedDict.fromkeys(results['name']):
+        comp = results['completion'][results['name'] == name]
+        lines.append('# {:<20s} {:15.4f}  {:.4f}'.format(
+            name, np.mean(comp), np.std(comp)))
+    for line in lines:
+        print(line)
+    if fname is not None:
+        with open(fname, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Simulate campaigns for many scenarios in parallel.',
+        epilog=('EXAMPLE: %(prog)s 2016-03-13 2016-03-20 decaps-tiles.fits '
+                'gr scenarios.json results.txt'))
+    parser.add_argument('start', type=str, help='first night, YYYY-MM-DD')
+    parser.add_argument('end', type=str, help='last night, YYYY-MM-DD')
+    parser.add_argument('tilefile', type=str, help='file name of tiles')
+    parser.add_argument('filters', type=str, help='filters to run')
+    parser.add_argument('scenarios', type=str,
+                        help='JSON file listing scenarios')
+    parser.add_argument('outfile', type=str, help='results file to write')
+    parser.add_argument('--realizations', type=int, default=1,
+                        help='number of weather realizations per scenario')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of processes; default one per core')
+    parser.add_argument('--weatherfile', type=str, default='',
+                        help=('mark exposures with bad quality from this '
+                              'file as not yet done before starting'))
+
+    args = parser.parse_args()
+
+    with open(args.scenarios) as f:
+        scenarios = json.load(f)
+    check_scenarios(scenarios)
+    for i, scenario in enumerate(scenarios):
+        scenario.setdefault('name', 'scenario%d' % i)
+    tiles = nightstrat.read_tiles(args.tilefile,
+                                  weatherfile=args.weatherfile)
+    results = run_scenarios(tiles, campaign.night_dates(args.start, args.end),
+                            args.filters, scenarios,
+                            realizations=args.realizations,
+                            workers=args.workers)
+    write_results(results, args.outfile)
+
+
+if __name__ == "__main__":
+    main()
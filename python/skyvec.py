@@ -0,0 +1,172 @@
+"""
+Vectorized spherical astronomy for the DECam planning tools.
+
+These routines work on whole numpy arrays of coordinates at once, and
+replace per-object pyephem calls in the inner loops of the planner.  They
+are accurate to about 1 arcmin in altitude above the airmass cutoff used in
+nightstrat.alt2airmass (see radec2altaz), which is far below anything that
+matters for choosing pointings.
+"""
+
+import numpy as np
+
+# Dublin Julian date (pyephem's day count) of the J2000 epoch
+J2000 = 36525.0
+
+
+def radec2vec(ra, dec):
+    '''
+    Unit vectors for the given ra, dec (in degrees).
+
+    Returns an array with shape ra.shape + (3,).
+    '''
+    ra = np.radians(ra)
+    dec = np.radians(dec)
+    cosdec = np.cos(dec)
+    return np.stack([cosdec*np.cos(ra), cosdec*np.sin(ra), np.sin(dec)],
+                    axis=-1)
+
+
+def vec2radec(vec):
+    '''
+    ra, dec (in degrees) of the given vectors, ra in [0, 360).
+    '''
+    vec = np.asarray(vec)
+    x, y, z = vec[..., 0], vec[..., 1], vec[..., 2]
+    ra = np.degrees(np.arctan2(y, x)) % 360.
+    dec = np.degrees(np.arctan2(z, np.hypot(x, y)))
+    return ra, dec
+
+
+def precession_matrix(date):
+    '''
+    IAU 1976 precession matrix from J2000 to the mean equinox of date.
+
+    date is a pyephem date (or float Dublin Julian day).
+    '''
+    t = (float(date) - J2000) / 36525.
+    arcsec = np.pi / 180. / 3600.
+    zeta = (2306.2181*t + 0.30188*t**2 + 0.017998*t**3) * arcsec
+    z = (2306.2181*t + 1.09468*t**2 + 0.018203*t**3) * arcsec
+    theta = (2004.3109*t - 0.42665*t**2 - 0.041833*t**3) * arcsec
+    czeta, szeta = np.cos(zeta), np.sin(zeta)
+    cz, sz = np.cos(z), np.sin(z)
+    cth, sth = np.cos(theta), np.sin(theta)
+    return np.array([
+        [cz*cth*czeta - sz*szeta, -cz*cth*szeta - sz*czeta, -cz*sth],
+        [sz*cth*czeta + cz*szeta, -sz*cth*szeta + cz*czeta, -sz*sth],
+        [sth*czeta, -sth*szeta, cth]])
+
+
+def precess(ra, dec, date):
+    '''
+    Precess J2000 ra, dec (in degrees) to the mean equinox of date.
+    '''
+    vec = radec2vec(ra, dec)
+    return vec2radec(np.dot(vec, precession_matrix(date).T))
+
+
+def refraction(alt, temp=10., pressure=1010., iterate=True):
+    '''
+    Atmospheric refraction (radians) to add to a true altitude (radians).
+
+    Uses the same formulae as libastro (and so pyephem): the Astronomical
+    Almanac form above 15 degrees and Saemundsson's below.  These are
+    functions of the apparent altitude, which with iterate is found with
+    one iteration from the true altitude.  Without it they are evaluated at
+    the true altitude, which is cheaper and errs by less than 0.2 arcmin
+    above 4 degrees.
+    '''
+    scale = pressure / (273. + temp)
+
+    def _refr(a):
+        a = np.degrees(np.clip(a, np.radians(-1.), np.pi/2.))
+        high = 0.00452 * scale / np.tan(np.radians(np.maximum(a, 15.)))
+        low = (scale * (0.1594 + a*(0.0196 + 0.00002*a)) /
+               (1. + a*(0.505 + 0.0845*a)))
+        return np.radians(np.where(a >= 15., high, low))
+
+    alt = np.asarray(alt, dtype='f8')
+    if iterate:
+        return _refr(alt + _refr(alt))
+    return _refr(alt)
+
+
+def radec2altaz(ra, dec, lst, lat, temp=None, pressure=None):
+    '''
+    Altitude and azimuth (radians) of ra, dec (degrees, equinox of date).
+
+    Inputs:
+        ra, dec   coordinates in degrees; arrays broadcast together
+        lst       local apparent sidereal time (radians)
+        lat       observer latitude (radians)
+        temp      temperature (deg C); no refraction if temp or pressure
+                  is None
+        pressure  pressure (mbar)
+    Output:
+        alt, az   in radians; az measured east of north, as in pyephem.
+    '''
+    ha = lst - np.radians(ra)
+    dec = np.radians(dec)
+    sindec, cosdec = np.sin(dec), np.cos(dec)
+    sinlat, coslat = np.sin(lat), np.cos(lat)
+    cosha = np.cos(ha)
+    alt = np.arcsin(np.clip(sindec*sinlat + cosdec*coslat*cosha, -1., 1.))
+    az = np.arctan2(-cosdec*np.sin(ha), sindec*coslat - cosdec*sinlat*cosha)
+    az = az % (2.*np.pi)
+    if temp is not None and pressure is not None:
+        alt = alt + refraction(alt, temp=temp, pressure=pressure)
+    return alt, az
+
+
+# Rotation from J2000 equatorial to galactic unit vectors (Hipparcos
+# definition; agrees with pyephem's ephem.Galactic to 0.01 arcsec).
+equ2gal_matrix = np.array([
+    [-0.0548755604162154, -0.8734370902348850, -0.4838350155487132],
+    [0.4941094278755837, -0.4448296299600112, 0.7469822444972189],
+    [-0.8676661490190047, -0.1980763734312015, 0.4559837761750669]])
+
+
+def equgal(ra, dec):
+    '''
+    Galactic l, b (degrees, l in [0, 360)) of J2000 ra, dec (degrees).
+    '''
+    vec = radec2vec(np.asarray(ra, dtype='f8'), np.asarray(dec, dtype='f8'))
+    return vec2radec(np.dot(vec, equ2gal_matrix.T))
+
+
+def galequ(l, b):
+    '''
+    J2000 ra, dec (degrees, ra in [0, 360)) of galactic l, b (degrees).
+    '''
+    vec = radec2vec(np.asarray(l, dtype='f8'), np.asarray(b, dtype='f8'))
+    return vec2radec(np.dot(vec, equ2gal_matrix))
+
+
+def gc_dist(lon1, lat1, lon2, lat2):
+    '''
+    Great-circle distance between two points on a sphere.
+    Inputs:
+        lon1  longitude (in degrees) of the first point
+        lat1  latitude (in degrees) of the first point
+        lon2  longitude (in degrees) of the second point
+        lat2  latitude (in degrees) of the second point
+    Output:
+        dist  angular distance (in degrees) between the two points.
+    '''
+    lon1 = np.radians(lon1)
+    lat1 = np.radians(lat1)
+    lon2 = np.radians(lon2)
+    lat2 = np.radians(lat2)
+
+    return np.degrees(
+        2. * np.arcsin(
+            np.sqrt(
+                np.sin(0.5*(lat1-lat2))**2 +
+                np.cos(lat1) * np.cos(lat2) * np.sin(0.5*(lon1-lon2))**2
+            )
+        )
+    )
+
+
+#####################################################
@@ -0,0 +1,135 @@
+"""
+Tests of the planning service on a small synthetic survey.
+
+python -m unittest test_planserver
+"""
+
+import json
+import threading
+import unittest
+from collections import OrderedDict
+
+import numpy as np
+
+try:
+    from urllib2 import urlopen, Request
+except ImportError:
+    from urllib.request import urlopen, Request
+
+try:
+    from BaseHTTPServer import HTTPServer
+except ImportError:
+    from http.server import HTTPServer
+
+import nightstrat
+import planserver
+
+start_time = '2016/3/14 03:12:00'
+json_keys = set(['expType', 'object', 'expTime', 'filter', 'RA', 'dec'])
+
+
+def make_survey():
+    """A grid of tiles every 3 deg, none of them observed yet."""
+    ra, dec = np.meshgrid(np.arange(0., 360., 3.), np.arange(-40., -19., 3.))
+    survey = OrderedDict()
+    survey['TILEID'] = np.arange(ra.size) + 1
+    survey['RA'] = ra.ravel()
+    survey['DEC'] = dec.ravel()
+    for f in 'GRIZY':
+        survey[f + '_DONE'] = np.zeros(ra.size, dtype='i8')
+    return survey
+
+
+class TestPlanner(unittest.TestCase):
+
+    def setUp(self):
+        self.survey = make_survey()
+        self.clock = planserver.FakeClock(start_time)
+        self.planner = planserver.Planner(self.survey, 'gr',
+                                          clock=self.clock)
+
+    def check_exposures(self, exps, n):
+        self.assertEqual(len(exps), n)
+        # as WriteJSON would write them
+        exps = json.loads(json.dumps(exps))
+        for exp in exps:
+            self.assertEqual(set(exp.keys()), json_keys)
+            self.assertEqual(exp['expType'], 'object')
+            self.assertIn(exp['filter'], 'gr')
+            self.assertEqual(exp['expTime'],
+                             nightstrat.exp_time_filters[exp['filter']])
+            tileid, filt = planserver.parse_object(exp)
+            self.assertEqual(filt, exp['filter'])
+            i = np.flatnonzero(self.survey['TILEID'] == tileid)
+            self.assertEqual(len(i), 1)
+            self.assertAlmostEqual(exp['RA'], self.survey['RA'][i[0]])
+            self.assertAlmostEqual(exp['dec'], self.survey['DEC'][i[0]])
+        return exps
+
+    def test_next_exposures(self):
+        exps = self.check_exposures(self.planner.next_exposures(n=5), 5)
+        self.assertEqual(self.planner.status(),
+                         {'g': len(self.survey['TILEID']),
+                          'r': len(self.survey['TILEID'])})
+
+        # after reporting the first two done, they are not planned again
+        self.clock.advance(600.)
+        again = self.check_exposures(
+            self.planner.next_exposures(completed=exps[:2], n=5), 5)
+        done = set(exp['object'] for exp in exps[:2])
+        self.assertFalse(done & set(exp['object'] for exp in again))
+        self.assertEqual(sum(self.planner.status().values()),
+                         2*len(self.survey['TILEID']) - 2)
+
+    def test_replan_same_time(self):
+        # replanning from the same state at the same time gives the same plan
+        first = self.planner.next_exposures(n=4)
+        self.assertEqual(self.planner.next_exposures(time=start_time, n=4),
+                         first)
+
+
+class TestServer(unittest.TestCase):
+
+    def setUp(self):
+        self.survey = make_survey()
+        self.planner = planserver.Planner(
+            self.survey, 'gr', clock=planserver.FakeClock(start_time))
+        handler = planserver.make_handler(self.planner)
+
+        class QuietHandler(handler):
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(('127.0.0.1', 0), QuietHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{:d}'.format(self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def post(self, path, obj):
+        req = Request(self.url + path, json.dumps(obj).encode('utf-8'),
+                      {'Content-Type': 'application/json'})
+        return json.loads(urlopen(req).read().decode('utf-8'))
+
+    def test_next(self):
+        exps = self.post('/next', {'n': 3})
+        self.assertEqual(len(exps), 3)
+        for exp in exps:
+            self.assertEqual(set(exp.keys()), json_keys)
+        # the reply is what the planner gives directly
+        self.assertEqual(exps, json.loads(json.dumps(
+            self.planner.next_exposures(n=3))))
+
+        reply = self.post('/clock', {'time': '2016/3/14 05:00:00'})
+        self.assertEqual(reply['time'], '2016/3/14 05:00:00')
+        later = self.post('/next', {'n': 3, 'completed': exps})
+        self.assertFalse(set(exp['object'] for exp in exps) &
+                         set(exp['object'] for exp in later))
+
+
+if __name__ == '__main__':
+    unittest.main()
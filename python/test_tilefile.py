@@ -0,0 +1,57 @@
+"""
+Tests of the delta log of the tile file.
+
+python -m unittest test_tilefile
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import tilefile
+
+
+class TestDelta(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.tfile = os.path.join(self.dir, 'tiles.fits')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def append(self, tileid, mjd_obs):
+        tilefile.append_delta(self.tfile, [tileid], ['g'], [mjd_obs],
+                              [tileid*10], ['2016-03-13'])
+
+    def test_append_after_partial_line(self):
+        self.append(6, 57461.2)
+        # a crash in the middle of writing the next line
+        with open(tilefile.delta_name(self.tfile), 'a') as f:
+            f.write('7 g 5746')
+        self.assertEqual(list(tilefile.read_delta(self.tfile)[0]), [6])
+
+        self.append(8, 57461.3)
+        tileid, filt, mjd_obs, expnum, dateobs = tilefile.read_delta(
+            self.tfile)
+        self.assertEqual(list(tileid), [6, 8])
+        self.assertTrue(np.allclose(mjd_obs, [57461.2, 57461.3]))
+        self.assertEqual(list(expnum), [60, 80])
+
+    def test_append_after_partial_first_line(self):
+        with open(tilefile.delta_name(self.tfile), 'w') as f:
+            f.write('7 g 57461.2 70 2016-03')
+        self.append(8, 57461.3)
+        self.assertEqual(list(tilefile.read_delta(self.tfile)[0]), [8])
+
+    def test_append_new_log(self):
+        self.append(8, 57461.3)
+        self.append(9, 57461.4)
+        self.assertEqual(list(tilefile.read_delta(self.tfile)[0]), [8, 9])
+
+
+if __name__ == '__main__':
+    unittest.main()
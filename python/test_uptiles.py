@@ -0,0 +1,101 @@
+"""
+Tests of finding new raw files in uptiles.
+
+python -m unittest test_uptiles
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import uptiles
+
+
+class WatcherTests(object):
+    """Tests run with and without inotify."""
+
+    use_inotify = False
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.dir, 'n1'))
+        # files created in a new directory may be reported created before
+        # they are watched, and so not reported closed
+        self.watcher = uptiles.Watcher('*/*_ooi_*.fits.fz', self.dir,
+                                       use_inotify=self.use_inotify,
+                                       settle=0.)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def write(self, name):
+        with open(self.path(name), 'w') as f:
+            f.write('data')
+
+    def new_files(self):
+        self.watcher.wait(0.1)
+        return [os.path.relpath(path, self.dir)
+                for path in self.watcher.new_files()]
+
+    def test_new_files(self):
+        self.write('n1/c4d_1_ooi_g.fits.fz')
+        self.write('n1/c4d_1_oki_g.fits.fz')
+        self.assertEqual(self.new_files(), ['n1/c4d_1_ooi_g.fits.fz'])
+        self.assertEqual(self.new_files(), [])
+
+        os.mkdir(self.path('n2'))
+        self.write('n2/c4d_2_ooi_r.fits.fz')
+        os.remove(self.path('n1/c4d_1_ooi_g.fits.fz'))
+        self.assertEqual(self.new_files(), ['n2/c4d_2_ooi_r.fits.fz'])
+
+    def test_moved_in(self):
+        self.write('n1/c4d_3_ooi_g.fits.fz.tmp')
+        self.assertEqual(self.new_files(), [])
+        os.rename(self.path('n1/c4d_3_ooi_g.fits.fz.tmp'),
+                  self.path('n1/c4d_3_ooi_g.fits.fz'))
+        self.assertEqual(self.new_files(), ['n1/c4d_3_ooi_g.fits.fz'])
+
+
+class TestWatcherScan(WatcherTests, unittest.TestCase):
+    pass
+
+
+@unittest.skipIf(uptiles.pyinotify is None, 'pyinotify is not installed')
+class TestWatcherInotify(WatcherTests, unittest.TestCase):
+
+    use_inotify = True
+
+    def test_uses_inotify(self):
+        self.assertIsNotNone(self.watcher.notifier)
+
+    def test_file_being_written(self):
+        self.watcher.settle = 30.
+        f = open(self.path('n1/c4d_4_ooi_g.fits.fz'), 'w')
+        f.write('part')
+        f.flush()
+        # another file arriving in the same directory meanwhile
+        self.write('n1/c4d_5_ooi_g.fits.fz')
+        self.assertEqual(self.new_files(), ['n1/c4d_5_ooi_g.fits.fz'])
+        f.write('rest')
+        f.close()
+        self.assertEqual(self.new_files(), ['n1/c4d_4_ooi_g.fits.fz'])
+
+    def test_never_closed(self):
+        self.watcher.settle = 0.5
+        f = open(self.path('n1/c4d_6_ooi_g.fits.fz'), 'w')
+        f.write('data')
+        f.flush()
+        self.assertEqual(self.new_files(), [])
+        time.sleep(0.6)
+        self.assertEqual(self.new_files(), ['n1/c4d_6_ooi_g.fits.fz'])
+        f.close()
+        self.assertEqual(self.new_files(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
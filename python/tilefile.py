@@ -0,0 +1,291 @@
+"""
+Reading and writing the tile status (obstatus) file.
+
+The tile file is a FITS table with, for each filter f in grizy, columns
+f_DONE, f_DATE, f_EXPNUM and f_MJD_OBS.  Rather than rewriting the whole
+table after every new exposure, uptiles appends the new observations to a
+delta log next to it (tfile + '.delta'), one line per observation:
+
+    TILEID FILTER MJD_OBS EXPNUM DATE
+
+and only occasionally folds the log into the table (compact).  Readers
+(read) apply the log to the table, so they always see every observation.
+The table itself is only ever replaced whole, by renaming a complete new
+file over it (write), so a reader never sees a partly written table.
+
+Applying an observation is idempotent (the latest observation of a tile in
+a filter wins), so it does not matter if a reader sees an observation both
+in the table and in the log.  For that reason readers read the log before
+the table: a log that has just been folded in is then still reflected in
+the new table.
+
+The tile table can also be kept as a TileStore: a directory of .npy files,
+one per column, which readers memory map rather than parse, and which
+uptiles updates in place.  fits_to_store and store_to_fits convert between
+the two, and read and uptiles.update accept either.
+"""
+
+import os
+import json
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+from astropy.io import fits
+
+
+def delta_name(tfile):
+    return tfile + '.delta'
+
+
+def apply_observations(tdata, rows, filt, mjd_obs, expnum, dateobs):
+    """
+    Mark rows of tdata observed in filters filt, unless they already have
+    later observations in those filters.  Of several observations of a tile
+    in a filter, the latest counts.
+
+    Returns a mask of the observations applied.
+    """
+    applied = np.zeros(len(rows), dtype='bool')
+    for f in 'grizy':
+        m = np.flatnonzero(filt == f)
+        if len(m) == 0:
+            continue
+        # the latest observation of each tile, as if applied in time order
+        m = m[np.lexsort((m, mjd_obs[m], rows[m]))]
+        last = np.ones(len(m), dtype='bool')
+        last[:-1] = rows[m[:-1]] != rows[m[1:]]
+        m = m[last]
+        m = m[tdata[f+'_mjd_obs'][rows[m]] <= mjd_obs[m]]
+        r = rows[m]
+        tdata[f+'_done'][r] = 1
+        tdata[f+'_date'][r] = dateobs[m]
+        tdata[f+'_expnum'][r] = expnum[m]
+        tdata[f+'_mjd_obs'][r] = mjd_obs[m]
+        applied[m] = True
+    return applied
+
+
+def drop_partial_line(fname, blocksize=1024):
+    """Truncate fname after its last newline, dropping an incomplete last
+    line left by a crash while appending."""
+    try:
+        f = open(fname, 'rb+')
+    except IOError:
+        return
+    with f:
+        f.seek(0, os.SEEK_END)
+        size = end = f.tell()
+        while end > 0:
+            start = max(end - blocksize, 0)
+            f.seek(start)
+            i = f.read(end - start).rfind(b'\n')
+            if i >= 0:
+                end = start + i + 1
+                break
+            end = start
+        if end < size:
+            f.truncate(end)
+
+
+def append_delta(tfile, tileid, filt, mjd_obs, expnum, dateobs):
+    """Append observations to the delta log of tfile."""
+    lines = ['%d %s %.8f %d %s\n' % row
+             for row in zip(tileid, filt, mjd_obs, expnum, dateobs)]
+    # otherwise the first new line would be glued onto the incomplete one,
+    # and both skipped by read_delta
+    drop_partial_line(delta_name(tfile))
+    with open(delta_name(tfile), 'a') as f:
+        f.write(''.join(lines))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def read_delta(tfile):
+    """
+    Observations in the delta log of tfile, as arrays tileid, filt,
+    mjd_obs, expnum, dateobs.  An incomplete last line (from a crash while
+    appending) is skipped, and dropped by the next append_delta.
+    """
+    rows = []
+    try:
+        f = open(delta_name(tfile))
+    except IOError:
+        f = None
+    if f is not None:
+        with f:
+            for line in f:
+                words = line.split()
+                if not line.endswith('\n') or len(words) != 5:
+                    continue
+                try:
+                    rows.append((int(words[0]), words[1], float(words[2]),
+                                 int(words[3]), words[4]))
+                except ValueError:
+                    continue
+    dtype = [('tileid', 'i8'), ('filter', 'S1'), ('mjd_obs', 'f8'),
+             ('expnum', 'i8'), ('dateobs', 'S10')]
+    delta = np.array(rows, dtype=dtype)
+    return (delta['tileid'], delta['filter'], delta['mjd_obs'],
+            delta['expnum'], delta['dateobs'])
+
+
+def apply_delta(tdata, delta):
+    """Apply observations from read_delta to tdata; returns the number of
+    observations applied."""
+    tileid, filt, mjd_obs, expnum, dateobs = delta
+    if len(tileid) == 0:
+        return 0
+    order = np.argsort(tdata['tileid'])
+    pos = np.searchsorted(tdata['tileid'], tileid, sorter=order)
+    rows = order[np.clip(pos, 0, len(order)-1)]
+    found = np.flatnonzero(tdata['tileid'][rows] == tileid)
+    applied = apply_observations(tdata, rows[found], filt[found],
+                                 mjd_obs[found], expnum[found],
+                                 dateobs[found])
+    return np.sum(applied)
+
+
+class TileStore(object):
+    """
+    Tile table kept as a directory of .npy files, one per column, listed in
+    columns.json, and opened as memory maps with mode mmap_mode ('r' to
+    read, 'r+' to update in place).
+
+    Columns are found by name regardless of case, as in a FITS table, and
+    len(store) is the number of tiles.  Assigning a column replaces it in
+    memory only; to change the store, assign to its elements.
+    """
+
+    def __init__(self, dirname, mmap_mode='r'):
+        self.dirname = dirname
+        with open(os.path.join(dirname, 'columns.json')) as f:
+            names = json.load(f)
+        self.columns = OrderedDict(
+            (str(name), np.load(os.path.join(dirname, name + '.npy'),
+                                mmap_mode=mmap_mode))
+            for name in names)
+
+    def __getitem__(self, name):
+        return self.columns[name.upper()]
+
+    def __setitem__(self, name, value):
+        self.columns[name.upper()] = np.asarray(value)
+
+    def __contains__(self, name):
+        return name.upper() in self.columns
+
+    def __len__(self):
+        for col in self.columns.values():
+            return len(col)
+        return 0
+
+    def keys(self):
+        return list(self.columns.keys())
+
+    def items(self):
+        return list(self.columns.items())
+
+    def flush(self):
+        """Write changes made in place to disk."""
+        for col in self.columns.values():
+            if isinstance(col, np.memmap):
+                col.flush()
+
+
+def is_store(path):
+    """Whether path is a TileStore directory."""
+    return os.path.isfile(os.path.join(path, 'columns.json'))
+
+
+def save_store(columns, dirname):
+    """Save columns (pairs of name, array, or a mapping) as a TileStore in
+    dirname."""
+    if hasattr(columns, 'items'):
+        columns = columns.items()
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    names = []
+    for name, col in columns:
+        col = np.asarray(col)
+        col = col.astype(col.dtype.newbyteorder('='))
+        np.save(os.path.join(dirname, name.upper() + '.npy'), col)
+        names.append(name.upper())
+    with open(os.path.join(dirname, 'columns.json'), 'w') as f:
+        json.dump(names, f)
+
+
+def fits_to_store(tfile, dirname):
+    """Convert the tile file tfile (with its delta log) to a TileStore."""
+    tdata = read(tfile)
+    save_store([(name, tdata[name]) for name in tdata.columns.names],
+               dirname)
+
+
+def store_to_fits(dirname, tfile):
+    """Write the TileStore in dirname as the FITS tile file tfile."""
+    store = TileStore(dirname)
+    tdata = np.rec.fromarrays([np.asarray(col) for col in
+                               store.columns.values()],
+                              names=store.keys())
+    compact(tdata, tfile)
+
+
+def read(tfile):
+    """The tile table of tfile, with its delta log applied, or the
+    TileStore if tfile is one."""
+    if is_store(tfile):
+        return TileStore(tfile)
+    delta = read_delta(tfile)
+    tdata = fits.getdata(tfile, 1)
+    apply_delta(tdata, delta)
+    return tdata
+
+
+def write(tdata, tfile):
+    """Replace tfile by tdata atomically: write a temporary file in the same
+    directory and rename it over tfile."""
+    dirname = os.path.dirname(os.path.abspath(tfile))
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.tmp-',
+                               suffix=os.path.basename(tfile))
+    os.close(fd)
+    try:
+        if os.path.exists(tfile):
+            os.chmod(tmp, os.stat(tfile).st_mode & 0o777)
+        else:
+            os.chmod(tmp, 0o644)
+        fits.writeto(tmp, tdata, overwrite=True)
+        os.rename(tmp, tfile)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def compact(tdata, tfile):
+    """Write tdata, which must include the delta log, to tfile and remove
+    the log."""
+    write(tdata, tfile)
+    if os.path.exists(delta_name(tfile)):
+        os.remove(delta_name(tfile))
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description=('Convert a tile file to a TileStore directory, or '
+                     'back.'),
+        epilog='EXAMPLE: %(prog)s decaps-tiles.fits decaps-tiles')
+    parser.add_argument('input', type=str,
+                        help='tile file or TileStore directory to read')
+    parser.add_argument('output', type=str,
+                        help='TileStore directory or tile file to write')
+    args = parser.parse_args()
+    if is_store(args.input):
+        store_to_fits(args.input, args.output)
+    else:
+        fits_to_store(args.input, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Spatial index of tile centers.
+
+Tiles are bucketed into declination bands and sorted by RA within each band,
+so that the tiles near a position can be found with a few binary searches
+rather than by computing distances to every tile.  The index also tracks
+which tiles are still open, so that the planner can drop tiles as they are
+completed.
+"""
+
+import numpy as np
+from skyvec import gc_dist
+
+
+class TileIndex(object):
+    """Index of tile centers ra, dec (deg), in bands of bandwidth deg."""
+
+    def __init__(self, ra, dec, bandwidth=2.):
+        self.ra = np.mod(np.asarray(ra, dtype='f8'), 360.)
+        self.dec = np.asarray(dec, dtype='f8')
+        self.bandwidth = float(bandwidth)
+        self.nband = int(np.ceil(180. / self.bandwidth))
+        band = self._band(self.dec)
+        self.order = np.lexsort((self.ra, band))
+        self.sortra = self.ra[self.order]
+        # increasing key of the sorted tiles, for searches in many bands
+        self.sortkey = band[self.order]*1000. + self.sortra
+        self.bandstart = np.searchsorted(band[self.order],
+                                         np.arange(self.nband+1))
+        self.open = np.ones(len(self.ra), dtype='bool')
+
+    def _band(self, dec):
+        return np.clip(np.floor((dec + 90.) / self.bandwidth).astype('i8'),
+                       0, self.nband-1)
+
+    def close(self, ind):
+        """Mark tiles ind as done, so that queries no longer return them."""
+        self.open[ind] = False
+
+    def _ranges(self, ra, dec, radius):
+        """Slices into order of tiles that may be within radius of ra, dec."""
+        ra = np.mod(ra, 360.)
+        b0 = self._band(dec - radius)
+        b1 = self._band(dec + radius)
+        if abs(dec) + radius >= 90.:
+            dra = 180.
+        else:
+            # half-width in RA of a cap of this radius
+            dra = np.degrees(np.arcsin(np.sin(np.radians(radius)) /
+                                       np.cos(np.radians(dec))))
+        ranges = []
+        for b in range(b0, b1+1):
+            lo, hi = self.bandstart[b], self.bandstart[b+1]
+            if dra >= 180.:
+                ranges.append((lo, hi))
+                continue
+            sra = self.sortra[lo:hi]
+            for r0, r1 in _ra_intervals(ra - dra, ra + dra):
+                ranges.append((lo + np.searchsorted(sra, r0, side='left'),
+                               lo + np.searchsorted(sra, r1, side='right')))
+        return ranges
+
+    def query(self, ra, dec, radius, open_only=True):
+        """Indices of the (open) tiles within radius (deg) of ra, dec."""
+        ranges = self._ranges(ra, dec, radius)
+        if len(ranges) == 0:
+            return np.zeros(0, dtype='i8')
+        ind = np.concatenate([self.order[lo:hi] for lo, hi in ranges])
+        if open_only:
+            ind = ind[self.open[ind]]
+        dist = gc_dist(self.ra[ind], self.dec[ind], ra, dec)
+        return np.sort(ind[dist <= radius])
+
+    def nearest(self, ra, dec, radius):
+        """
+        Index of the nearest tile (open or not) within radius (deg) of each
+        of the positions ra, dec, or -1 if there is none, and its distance.
+
+        All positions are matched at once.  The work per position grows with
+        the number of tiles in a band within radius in RA, so this is meant
+        for small radii.
+        """
+        ra = np.mod(np.atleast_1d(np.asarray(ra, dtype='f8')), 360.)
+        dec = np.atleast_1d(np.asarray(dec, dtype='f8'))
+        best = -np.ones(len(ra), dtype='i8')
+        bestdist = np.full(len(ra), np.inf)
+        if len(ra) == 0 or len(self.ra) == 0:
+            return best, bestdist
+        polar = np.abs(dec) + radius >= 90.
+        cosdec = np.cos(np.radians(np.where(polar, 0., dec)))
+        dra = np.where(polar, 180., np.degrees(np.arcsin(np.clip(
+            np.sin(np.radians(radius)) / cosdec, 0., 1.))))
+        b0 = self._band(dec - radius)
+        b1 = self._band(dec + radius)
+        for db in range(np.max(b1 - b0) + 1):
+            b = b0 + db
+            for shift in (-360., 0., 360.):
+                ra0 = ra - dra + shift
+                ra1 = ra + dra + shift
+                ok = (b <= b1) & (ra1 >= 0.) & (ra0 < 360.)
+                lo = np.searchsorted(self.sortkey,
+                                     b*1000. + np.clip(ra0, 0., 360.),
+                                     side='left')
+                hi = np.searchsorted(self.sortkey,
+                                     b*1000. + np.clip(ra1, 0., 360.),
+                                     side='right')
+                hi = np.where(ok, hi, lo)
+                for k in range(np.max(hi - lo)):
+                    m = np.flatnonzero(lo + k < hi)
+                    ind = self.order[lo[m] + k]
+                    dist = gc_dist(self.ra[ind], self.dec[ind], ra[m],
+                                    dec[m])
+                    closer = dist < bestdist[m]
+                    best[m[closer]] = ind[closer]
+                    bestdist[m[closer]] = dist[closer]
+        found = bestdist <= radius
+        best[~found] = -1
+        bestdist[~found] = np.inf
+        return best, bestdist
+
+
+def _ra_intervals(ra0, ra1):
+    """Split the RA interval [ra0, ra1] (deg), where -360 < ra0 <= ra1 <
+    720 and ra1 - ra0 < 360, into intervals within [0, 360)."""
+    if ra0 < 0.:
+        return [(ra0 + 360., 360.), (0., ra1)]
+    if ra1 >= 360.:
+        return [(ra0, 360.), (0., ra1 - 360.)]
+    return [(ra0, ra1)]
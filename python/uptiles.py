@@ -65,41 +65,164 @@ import os
 import fnmatch
 import dateutil.parser
 import datetime
+import sqlite3
 from astropy.io import fits
-import fitsio
+import tileindex
+import tilefile
+from tilefile import apply_observations
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
 
 
-# stolen from internet, Simon Brunning
-def locate(pattern, root=None):
-    '''Locate all files matching supplied filename pattern in and below
-    supplied root directory.'''
-    if root is None:
-        root = os.curdir
-    for path, dirs, files in os.walk(os.path.abspath(root)):
-        files2 = [os.path.join(os.path.relpath(path, start=root), f)
-                  for f in files]
-        for filename in fnmatch.filter(files2, pattern):
-            yield os.path.join(os.path.abspath(root), filename)
+class Watcher(object):
+    """
+    Find new files matching expr below topdir.  new_files returns each file
+    once, in order of arrival (modification time).
 
+    Directories are only listed when they change: when inotify (through
+    pyinotify, if installed) reports events in them, or otherwise when their
+    modification time changes, so that a poll costs one stat per directory
+    rather than a walk of the whole tree.  With inotify, a file seen being
+    created is only returned once it has been closed after writing, or
+    if that is missed, once it has not been modified for settle seconds.
+    Deleted or renamed files are never returned again, and do not upset the
+    other files.
+    """
 
-def search(expr, topdir=None):
-    files = numpy.array(list(locate(expr, root=topdir)))
-    s = numpy.argsort(files)
-    files = files[s]
-    return files
+    def __init__(self, expr, topdir, use_inotify=True, settle=30.):
+        self.expr = expr
+        self.topdir = os.path.abspath(topdir)
+        self.processed = set()
+        self.mtimes = {}
+        self.subdirs = {}
+        self.dirty = set([self.topdir])
+        self.writing = set()
+        self.settle = settle
+        self.notifier = None
+        if use_inotify and pyinotify is not None:
+            try:
+                self._start_inotify()
+            except (OSError, pyinotify.WatchManagerError) as e:
+                print('inotify unavailable (%s); scanning directories.' % e)
+                self.notifier = None
 
+    def _created(self, path, pathname, isdir):
+        """inotify: pathname was created in directory path."""
+        if isdir:
+            self.dirty.add(path)
+            self.dirty.add(pathname)
+        else:
+            # not complete until closed
+            self.writing.add(pathname)
+
+    def _written(self, path, pathname):
+        """inotify: pathname in directory path was closed after writing, or
+        moved there."""
+        self.writing.discard(pathname)
+        self.dirty.add(path)
+
+    def _start_inotify(self):
+        watcher = self
+
+        class Handler(pyinotify.ProcessEvent):
+            def process_IN_CREATE(self, event):
+                watcher._created(event.path, event.pathname, event.dir)
+
+            def process_IN_CLOSE_WRITE(self, event):
+                watcher._written(event.path, event.pathname)
 
-def gc_dist(lon1, lat1, lon2, lat2):
-    from numpy import sin, cos, arcsin, sqrt
+            process_IN_MOVED_TO = process_IN_CLOSE_WRITE
 
-    lon1 = numpy.radians(lon1)
-    lat1 = numpy.radians(lat1)
-    lon2 = numpy.radians(lon2)
-    lat2 = numpy.radians(lat2)
+        wm = pyinotify.WatchManager()
+        mask = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO |
+                pyinotify.IN_CREATE)
+        wm.add_watch(self.topdir, mask, rec=True, auto_add=True,
+                     quiet=False)
+        self.notifier = pyinotify.Notifier(wm, Handler())
 
-    return numpy.degrees(2*arcsin(sqrt(
-        (sin((lat1-lat2)*0.5))**2 +
-        cos(lat1)*cos(lat2)*(sin((lon1-lon2)*0.5))**2)))
+    def _events(self, timeout):
+        """Collect inotify events, waiting up to timeout seconds."""
+        if self.notifier.check_events(timeout=int(timeout*1000)):
+            self.notifier.read_events()
+            self.notifier.process_events()
+
+    def _changed_dirs(self):
+        if self.notifier is not None:
+            self._events(0)
+            dirs = self.dirty.copy()
+            self.dirty.clear()
+            return dirs
+        dirs = []
+        stack = [self.topdir]
+        while stack:
+            d = stack.pop()
+            try:
+                mtime = os.stat(d).st_mtime
+            except OSError:
+                continue
+            if self.mtimes.get(d) != mtime:
+                dirs.append(d)
+            stack.extend(self.subdirs.get(d, ()))
+        return dirs
+
+    def _list(self, d):
+        """Matching files in d, and in new directories below it."""
+        try:
+            mtime = os.stat(d).st_mtime
+            names = os.listdir(d)
+        except OSError:
+            self.subdirs.pop(d, None)
+            return []
+        # Files arriving within the resolution of the mtime could be missed;
+        # list recently modified directories again next time.
+        if time.time() - mtime > 2.:
+            self.mtimes[d] = mtime
+        old = self.subdirs.get(d, [])
+        subdirs = []
+        files = []
+        rel = os.path.relpath(d, start=self.topdir)
+        for name in names:
+            path = os.path.join(d, name)
+            if os.path.isdir(path):
+                subdirs.append(path)
+            elif fnmatch.fnmatch(os.path.join(rel, name), self.expr):
+                files.append(path)
+        self.subdirs[d] = subdirs
+        for sub in subdirs:
+            if sub not in old:
+                files.extend(self._list(sub))
+        return files
+
+    def new_files(self):
+        """Files that have appeared since the last call, oldest first."""
+        files = set()
+        for d in self._changed_dirs():
+            files.update(self._list(d))
+        new = []
+        now = time.time()
+        for path in (files | self.writing) - self.processed:
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                self.writing.discard(path)
+                continue
+            if path in self.writing and now - mtime < self.settle:
+                continue
+            new.append((mtime, path))
+        new.sort()
+        new = [path for mtime, path in new]
+        self.processed.update(new)
+        self.writing.difference_update(new)
+        return new
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds for new files."""
+        if self.notifier is not None:
+            self._events(timeout)
+        else:
+            time.sleep(timeout)
 
 
 def str2dec(string):
@@ -115,109 +238,328 @@ def str2dec(string):
     return sign * (h + (m / 60.) + (s / 60. / 60.))
 
 
-def process(file, tdata, minexptime=25):
-    print('Processing file %s' % os.path.basename(file))
-    qdone = False
-    for i in xrange(5):
+def read_primary_header(file):
+    """Primary header of file, reading only its header blocks."""
+    blocks = []
+    with open(file, 'rb') as f:
+        while True:
+            block = f.read(2880)
+            if len(block) < 2880:
+                raise IOError('No END card in primary header of %s' % file)
+            blocks.append(block)
+            if any(block[i:i+80].rstrip() == b'END'
+                   for i in range(0, 2880, 80)):
+                break
+    return fits.Header.fromstring(b''.join(blocks).decode('ascii'))
+
+
+def read_header(file, ntry=5, wait=2.):
+    """Primary header of file, retrying in case it is still being written;
+    None if it cannot be read."""
+    for i in xrange(ntry):
         try:
-            # hdr = fits.getheader(file)
-            hdr = fitsio.read_header(file)
-        except:
-            time.sleep(2)
-        else:
-            qdone = True
-    if not qdone:
-        print('Could not read file %s' % file)
-        return
-    obstype = hdr['OBSTYPE'].strip()
-    exptime = hdr['EXPTIME']
-    expnum = hdr['EXPNUM']
-    ra = str2dec(hdr['ra'])*15.
-    dec = str2dec(hdr['dec'])
+            return read_primary_header(file)
+        except Exception:
+            if i < ntry-1:
+                time.sleep(wait)
+    print('Could not read file %s' % file)
+    return None
+
+
+# Header values collected from each raw file; ok is False if the file could
+# not be read.
+exposure_dtype = [('expnum', 'i8'), ('object', 'S40'), ('ra', 'f8'),
+                  ('dec', 'f8'), ('filter', 'S1'), ('mjd_obs', 'f8'),
+                  ('exptime', 'f8'), ('obstype', 'S20'), ('dateobs', 'S10'),
+                  ('ok', 'bool')]
+
+
+def read_exposure(file):
+    """Row of exposure_dtype for file."""
+    hdr = read_header(file)
+    if hdr is None:
+        return (0, '', 0., 0., '', 0., 0., '', '', False)
     dateobstime = dateutil.parser.parse(hdr['DATE-OBS'])
     dateobstime = dateobstime + datetime.timedelta(hours=-18)
-    dateobs = dateobstime.isoformat()[0:10]
-    mjd_obs = hdr['MJD-OBS']
-
-    obj = hdr['OBJECT']
-    filt = hdr['filter'][0:1].lower()
-    obj3 = obj.split('_')
-    if (obstype != 'object') or (exptime <= minexptime):
-        print(obstype, exptime, hdr['OBJECT'])
-        tileid = 0
+    return (hdr['EXPNUM'], hdr['OBJECT'], str2dec(hdr['ra'])*15.,
+            str2dec(hdr['dec']), hdr['filter'][0:1].lower(), hdr['MJD-OBS'],
+            hdr['EXPTIME'], hdr['OBSTYPE'].strip(),
+            dateobstime.isoformat()[0:10], True)
+
+
+def read_exposures(files, workers=8):
+    """Table (of exposure_dtype) of the headers of files, read by a pool of
+    workers threads."""
+    if workers > 1 and len(files) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            rows = list(pool.map(read_exposure, files))
     else:
+        rows = [read_exposure(file) for file in files]
+    return numpy.array(rows, dtype=exposure_dtype)
+
+
+class TileMatcher(object):
+    """
+    Index of the tiles of tdata, to find the rows of whole batches of
+    exposures by TILEID (binary search on the sorted ids) or by position
+    (nearest tile within radius deg, with a tileindex.TileIndex).
+    """
+
+    def __init__(self, tdata, radius=1./60.):
+        self.tileid = numpy.asarray(tdata['tileid'])
+        self.order = numpy.argsort(self.tileid)
+        self.index = tileindex.TileIndex(tdata['ra'], tdata['dec'])
+        self.radius = radius
+
+    def rows(self, tileid):
+        """Rows of the tiles tileid, -1 where there is no such tile."""
+        tileid = numpy.asarray(tileid)
+        if len(self.tileid) == 0:
+            return -numpy.ones(tileid.shape, dtype='i8')
+        pos = numpy.searchsorted(self.tileid, tileid, sorter=self.order)
+        rows = self.order[numpy.clip(pos, 0, len(self.order)-1)]
+        return numpy.where(self.tileid[rows] == tileid, rows, -1)
+
+    def match(self, ra, dec):
+        """Rows of the tiles nearest ra, dec if closer than radius, else
+        -1."""
+        rows, dist = self.index.nearest(ra, dec, self.radius)
+        rows[dist >= self.radius] = -1
+        return rows
+
+
+def ingest(tdata, exps, minexptime=25, matcher=None):
+    """
+    Mark the tiles observed in exps (a table of exposure_dtype) as done in
+    tdata, in one pass.
+
+    Exposures must be OBSTYPE='object' and EXPTIME > minexptime.  Tiles are
+    identified by OBJECT names DECaPS_<TILEID>_<filter>, or else as the
+    tile within 1 arcmin, with matcher (a TileMatcher for tdata, built if
+    not given).  Returns the tile id of each exposure (0 if none) and the
+    outcome: 'added', 'older' (the tile has a later observation), 'not
+    object', 'no tile', 'bad filter' or 'unreadable'.
+    """
+    if matcher is None:
+        matcher = TileMatcher(tdata)
+    n = len(exps)
+    tileid = numpy.zeros(n, dtype='i8')
+    status = numpy.zeros(n, dtype='S10')
+    status[:] = 'unreadable'
+    isobj = (exps['ok'] & (exps['obstype'] == 'object') &
+             (exps['exptime'] > minexptime))
+    status[exps['ok'] & ~isobj] = 'not object'
+    named = numpy.zeros(n, dtype='bool')
+    for i in numpy.flatnonzero(isobj):
+        obj3 = exps['object'][i].split('_')
         if (obj3[0] == 'DECaPS') and (len(obj3) == 3):
-            tileid = int(obj3[1])
-        else:
-            dd = gc_dist(tdata['ra'], tdata['dec'], ra, dec)
-            imin = numpy.argmin(dd)
-            dmin = dd[imin]
-            if dmin < 1./60.:
-                tileid = int(tdata[imin]['tileid'])
-            else:
-                tileid = 0
-                print(hdr['OBJECT'])
-
-    if tileid <= 0:
-        print('Invalid TILEID = %d' % tileid)
-        return
-    ind = numpy.flatnonzero(tdata['tileid'] == tileid)
-    if len(ind) == 0:
-        print('Invalid TILEID = %d' % tileid)
-        return
-    if filt not in 'grizy':
-        print('Invalid filter %s' % filt)
-        return
-    if tdata[filt+'_mjd_obs'][ind] > mjd_obs:
-        print('Ignoring TILEID=%d FILTER=%s MJD=%f; older than existing tile.'
-              % (tileid, filt, mjd_obs))
-        print(mjd_obs, tdata[filt+'_mjd_obs'][ind])
-    else:
-        print('Adding TILEID=%d FILTER=%s MJD=%f' % (tileid, filt, mjd_obs))
-        tdata[filt+'_done'][ind] = 1
-        tdata[filt+'_date'][ind] = dateobs
-        tdata[filt+'_expnum'][ind] = expnum
-        tdata[filt+'_mjd_obs'][ind] = mjd_obs
+            tileid[i] = int(obj3[1])
+            named[i] = True
+    rows = matcher.rows(tileid)
+    near = numpy.flatnonzero(isobj & ~named)
+    rows[near] = matcher.match(exps['ra'][near], exps['dec'][near])
+    tileid[near] = numpy.where(rows[near] >= 0,
+                               matcher.tileid[rows[near]], 0)
+    found = (tileid > 0) & (rows >= 0)
+    status[isobj & ~found] = 'no tile'
+    goodfilt = numpy.array([f != '' and f in 'grizy' for f in exps['filter']],
+                           dtype='bool')
+    status[isobj & found & ~goodfilt] = 'bad filter'
+    use = numpy.flatnonzero(isobj & found & goodfilt)
+    applied = apply_observations(tdata, rows[use], exps['filter'][use],
+                                 exps['mjd_obs'][use], exps['expnum'][use],
+                                 exps['dateobs'][use])
+    status[use] = numpy.where(applied, 'added', 'older')
+    for s in ['added', 'older', 'not object', 'no tile', 'bad filter',
+              'unreadable']:
+        if numpy.any(status == s):
+            print('%6d exposures %s' % (numpy.sum(status == s), s))
+    return tileid, status
+
+
+def process(file, tdata, minexptime=25):
+    """Mark the tile observed in file as done in tdata.
+
+    Returns the outcome (see ingest)."""
+    print('Processing file %s' % os.path.basename(file))
+    tileid, status = ingest(tdata, read_exposures([file]),
+                            minexptime=minexptime)
+    return status[0]
+
+
+class Ledger(object):
+    """
+    SQLite record of the files processed, with their size and modification
+    time and the exposure found in each, so that a restarted update only
+    reads new or changed files, and the tile file can be rebuilt without
+    reading any raw files (replay).
+    """
+
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, '
+            'size INTEGER, mtime REAL, expnum INTEGER, tileid INTEGER, '
+            'filter TEXT, mjd_obs REAL, dateobs TEXT, status TEXT)')
+        self.db.commit()
+
+    def unchanged(self, path):
+        """Whether path has been processed and not changed since."""
+        row = self.db.execute('SELECT size, mtime FROM files WHERE path = ?',
+                              (path,)).fetchone()
+        if row is None:
+            return False
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        return row[0] == st.st_size and row[1] == st.st_mtime
+
+    def record(self, files, exps, tileid, status):
+        """Record the exposures exps read from files, and their tile ids and
+        outcomes from ingest.  Unreadable files are not recorded, so that
+        they are tried again."""
+        values = []
+        for i, path in enumerate(files):
+            if not exps['ok'][i]:
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            values.append((path, st.st_size, st.st_mtime,
+                           int(exps['expnum'][i]), int(tileid[i]),
+                           str(exps['filter'][i]),
+                           float(exps['mjd_obs'][i]),
+                           str(exps['dateobs'][i]), str(status[i])))
+        self.db.executemany(
+            'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            values)
+
+    def commit(self):
+        self.db.commit()
+
+    def replay(self, tdata):
+        """Apply the recorded exposures to tdata; returns the number of
+        tiles updated."""
+        rows = self.db.execute(
+            'SELECT tileid, filter, mjd_obs, expnum, dateobs FROM files '
+            "WHERE status IN ('added', 'older')").fetchall()
+        if len(rows) == 0:
+            return 0
+        tileid, filt, mjd_obs, expnum, dateobs = [
+            numpy.array(col) for col in zip(*rows)]
+        order = numpy.argsort(tdata['tileid'])
+        pos = numpy.searchsorted(tdata['tileid'], tileid, sorter=order)
+        ind = order[numpy.clip(pos, 0, len(order)-1)]
+        found = numpy.flatnonzero(tdata['tileid'][ind] == tileid)
+        applied = apply_observations(
+            tdata, ind[found], filt[found].astype('S1'), mjd_obs[found],
+            expnum[found], dateobs[found].astype('S10'))
+        return numpy.sum(applied)
+
+    def close(self):
+        self.db.close()
 
 
 def write(tdata, tfile):
     print('Writing file %s' % tfile)
-    fits.writeto(tfile, tdata, clobber=True)
+    if isinstance(tdata, tilefile.TileStore):
+        tdata.flush()
+    else:
+        tilefile.compact(tdata, tfile)
+
+
+def open_tiles(tfile, debug=False):
+    """The tile table of tfile for updating: a TileStore opened for update in
+    place (copy on write if debug, so that tfile is left alone), or the FITS
+    table with its delta log applied."""
+    if tilefile.is_store(tfile):
+        return tilefile.TileStore(tfile, mmap_mode='c' if debug else 'r+')
+    return tilefile.read(tfile)
 
 
 def update(expr='*/*_ooi_*.fits.fz', topdir=None, tfile=None, wtime=None,
-           noloop=False, debug=False):
+           noloop=False, debug=False, ledger=None, rebuild=False,
+           workers=8, compact_every=1000):
+    """Watch for new raw files and mark their tiles done in tfile.
+
+    ledger: SQLite file recording the files processed (see Ledger); files
+    already in it and unchanged are skipped, so that a restart only reads
+    new files.  With rebuild, the exposures in the ledger are applied to
+    tfile without reading any raw files, and update returns.
+
+    Headers of new files are read by a pool of workers threads, and the
+    tiles updated in one pass (ingest).  New observations are appended to
+    the delta log of tfile (see tilefile), which is folded into tfile once
+    it holds compact_every observations, and on exit with noloop; with
+    compact_every=0, tfile is rewritten after every batch.  tfile may also
+    be a tilefile.TileStore directory, which is updated in place.
+    """
+    if tfile is None:
+        tfile = os.path.join(os.environ['HOME'], 'observing', 'obstatus',
+                             'decam-tiles_obstatus.fits')
+    if rebuild:
+        if ledger is None:
+            raise ValueError('rebuild needs a ledger!')
+        tdata = open_tiles(tfile, debug)
+        led = Ledger(ledger)
+        print('Replayed %d exposures from %s' % (led.replay(tdata), ledger))
+        led.close()
+        if not debug:
+            write(tdata, tfile)
+        return
     if topdir is None:
         topdir = os.environ.get('DECAM_DATA', '')
     if topdir == '':
         raise ValueError('topdir keyword or $DECAM_DATA env must be set!')
-    if tfile is None:
-        tfile = os.path.join(os.environ['HOME'], 'observing', 'obstatus',
-                             'decam-tiles_obstatus.fits')
     if wtime is None:
         wtime = 10
     if wtime < 1:
         wtime = 1
 
-    tdata = fits.getdata(tfile, 1)
+    tdata = open_tiles(tfile, debug)
+    led = Ledger(ledger) if ledger is not None else None
+    if isinstance(tdata, tilefile.TileStore):
+        compact_every = 0  # flush after every batch
+        ndelta = 0
+    else:
+        ndelta = len(tilefile.read_delta(tfile)[0])
 
-    nfile = 0
+    matcher = TileMatcher(tdata)
+    watcher = Watcher(expr, topdir)
     while True:
         print('uptiles checking for new files...')
-        files = search(expr, topdir=topdir)
-        if len(files) != nfile:
-# if I really know the order and what it means, better to just check if the
-# last file is the same as it used to be?  Currently seems fragile to file
-# deletion, weird files, ...
-            for i in xrange(nfile, len(files)):
-                if (i % 100) == 0:
-                    print('Processing file %d of %d' % (i+1, len(files)-nfile))
-                    print(i, len(files)-nfile)
-                process(files[i], tdata, minexptime=25)
+        files = watcher.new_files()
+        if led is not None:
+            files = [file for file in files if not led.unchanged(file)]
+        if len(files) > 0:
+            print('Processing %d files' % len(files))
+            exps = read_exposures(files, workers=workers)
+            tileid, status = ingest(tdata, exps, minexptime=25,
+                                    matcher=matcher)
             if not debug:
-                write(tdata, tfile)
-            nfile = len(files)
+                added = numpy.flatnonzero(status == 'added')
+                ndelta += len(added)
+                if ndelta >= compact_every:
+                    write(tdata, tfile)
+                    ndelta = 0
+                elif len(added) > 0:
+                    tilefile.append_delta(
+                        tfile, tileid[added], exps['filter'][added],
+                        exps['mjd_obs'][added], exps['expnum'][added],
+                        exps['dateobs'][added])
+                # only once the observations are in tfile or its delta log,
+                # so that a debug run leaves the ledger alone
+                if led is not None:
+                    led.record(files, exps, tileid, status)
+                    led.commit()
         if noloop:
+            if ndelta > 0 and not debug:
+                write(tdata, tfile)
             break
         else:
-            time.sleep(wtime)
+            watcher.wait(wtime)
+    if led is not None:
+        led.close()